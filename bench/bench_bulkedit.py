@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Time to retag many cases, one edit after another and with BulkEdit
+
+Usage: bench_bulkedit.py [options]
+
+Sends sTags edits to a mock server with --latency, --capacity and
+--error-rate: the first --serial-edits one after another through
+FogBugzAPI.call, like a simple script would, then all --edits through
+FogBugzAPI.edit_many with --workers workers.
+"""
+
+import logging
+from optparse import OptionParser
+import time
+
+from mockserver import MockFogBugz, SyntheticData
+from fogpy.fogbugzapi import FogBugzAPI
+
+def edits(n):
+    for ix in xrange(1, n + 1):
+        yield ix, {'sTags': ['tag%d' % (ix % 7)]}
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("--edits", type='int', default=2000)
+    parser.add_option("--serial-edits", type='int', default=200)
+    parser.add_option("--workers", type='int', default=16)
+    parser.add_option("--latency", type='float', default=.1)
+    parser.add_option("--capacity", type='int', default=None)
+    parser.add_option("--error-rate", type='float', default=.01)
+    options, args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    server = MockFogBugz(SyntheticData(cases=options.edits),
+                         latency=options.latency, capacity=options.capacity,
+                         error_rate=options.error_rate).start()
+
+    api = FogBugzAPI(server.base_url, 'bench', 'bench')
+    failed = 0
+    t = time.time()
+    for bug_id, changes in edits(options.serial_edits):
+        try:
+            api.call('edit', ixBug=bug_id, sTags=','.join(changes['sTags']))
+        except Exception:
+            failed += 1
+    seconds = time.time() - t
+    print '%-20s %8.2fs %7.1f edits/s %6d edits, %d failed' % (
+        'serial', seconds, options.serial_edits / seconds,
+        options.serial_edits, failed)
+    api.logout()
+
+    api = FogBugzAPI(server.base_url, 'bench', 'bench',
+                     pool_size=options.workers)
+    before = server.snapshot()
+    t = time.time()
+    results = api.edit_many(edits(options.edits), workers=options.workers)
+    seconds = time.time() - t
+    after = server.snapshot()
+    print '%-20s %8.2fs %7.1f edits/s %6d edits, %d failed, %d requests' % (
+        'edit_many, %d workers' % options.workers, seconds,
+        options.edits / seconds, options.edits,
+        sum(1 for r in results if not r.ok),
+        sum(after.get(k, 0) - before.get(k, 0)
+            for k in ('cmd:edit', 'failed', 'rejected')))
+    api.logout()
+    server.shutdown()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Compare EntryTable with a list of namedtuples and nested dict sums
+
+Usage: bench_entries.py [number of entries]
+
+Each variant runs in its own process so peak memory can be compared.
+"""
+
+from collections import defaultdict, namedtuple
+from multiprocessing import Process, Queue
+import random
+import resource
+import sys
+import time
+
+from fogpy.entries import ELAPSED, TIMESHEET, EntryTable, Interner
+
+N_DEVS, N_BUGS, N_TAGS = 50, 20000, 40
+
+TimeEntry = namedtuple('TimeEntry',
+                       ('date', 'bug_num', 'dev_name', 'hours', 'tag', 'type'))
+
+def synthetic(n):
+    rnd = random.Random(42)
+    bug_tags = dict((b, 'P-t%d' % rnd.randrange(N_TAGS))
+                    for b in xrange(N_BUGS))
+    for _ in xrange(n):
+        bug = rnd.randrange(N_BUGS)
+        # most of a bug's time is logged by the dev it's assigned to
+        dev = bug % N_DEVS if rnd.random() < .9 else rnd.randrange(N_DEVS)
+        yield (1300000000 + rnd.randrange(31536000), bug, dev,
+               rnd.random() * 4,
+               ELAPSED if rnd.random() < .05 else TIMESHEET, bug_tags[bug])
+
+def maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_tuples(n, out):
+    rss = maxrss()
+    entries = []
+    for date, bug, dev, hours, entry_type, tag in synthetic(n):
+        entries.append(TimeEntry('%d' % date, bug, 'dev %d' % dev, hours,
+                                 tag, 'timesheet'))
+    rss = maxrss() - rss
+    t = time.time()
+    hours_perdev = defaultdict(lambda: defaultdict(int))
+    for e in entries:
+        hours_perdev[e.dev_name][e.tag] += e.hours
+        hours_perdev[e.dev_name]['total'] += e.hours
+    out.put(('namedtuples', time.time() - t, rss))
+
+def run_table(n, out):
+    rss = maxrss()
+    table = EntryTable()
+    bug_tag = {}
+    for date, bug, dev, hours, entry_type, tag in synthetic(n):
+        table.append(date, bug, dev, hours, entry_type)
+        bug_tag[bug] = tag
+    rss = maxrss() - rss
+    t = time.time()
+    tags = Interner(['total'])
+    sums = defaultdict(float)
+    for (dev, bug), hours in table.sum_hours('dev', 'bug').iteritems():
+        sums[dev, tags.code(bug_tag[bug])] += hours
+        sums[dev, 0] += hours
+    out.put(('EntryTable', time.time() - t, rss))
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    out = Queue()
+    print '%d entries' % n
+    for target in (run_tuples, run_table):
+        p = Process(target=target, args=(n, out))
+        p.start()
+        name, seconds, kb = out.get()
+        p.join()
+        print '%-12s aggregate %.3fs, memory %.1f bytes/entry' % (
+            name, seconds, kb * 1024. / n)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Reports on several FogBugz instances, one after another and in parallel
+
+Usage: bench_multi.py [options]
+
+Starts a mock server per number of intervals in --intervals (comma
+separated), each in its own process like a real instance would be, then
+times a report on each instance in turn, and fogpy.multireport's
+run_reports on all of them at once, which should take about as long as
+the slowest instance. A last instance nothing listens on shows a failing
+instance doesn't hold up the others.
+"""
+
+import datetime as dt
+import logging
+from optparse import OptionParser
+import os
+import subprocess
+import sys
+import time
+
+from fogpy.multireport import Instance, report_instance, run_reports
+
+def start_server(options, n_intervals):
+    p = subprocess.Popen(
+        [sys.executable, '-u',
+         os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'mockserver.py'),
+         '--port', '0', '--people', str(options.people),
+         '--cases', str(options.cases), '--intervals', str(n_intervals),
+         '--latency', str(options.latency)],
+        stdout=subprocess.PIPE)
+    # Serving on <base_url>
+    return p, p.stdout.readline().split()[-1]
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("--intervals", default='5000,10000,20000')
+    parser.add_option("--people", type='int', default=20)
+    parser.add_option("--cases", type='int', default=2000)
+    parser.add_option("--latency", type='float', default=.05)
+    options, args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    servers = [start_server(options, int(n))
+               for n in options.intervals.split(',')]
+    instances = [Instance('instance%d' % n, url, 'bench', 'bench')
+                 for n, (p, url) in enumerate(servers)]
+    instances.append(Instance('unreachable', 'http://127.0.0.1:1/api.asp',
+                              'bench', 'bench'))
+    start, end = dt.datetime(2011, 1, 1), dt.datetime(2012, 1, 1)
+    try:
+        total = 0.
+        for instance in instances:
+            r = report_instance(instance, start, end)
+            total += r.seconds
+            print '%-12s %6.2fs  %s' % (instance.name, r.seconds,
+                                        r.status[:50])
+        print '%-12s %6.2fs' % ('one by one', total)
+        t = time.time()
+        report = run_reports(instances, start, end)
+        print '%-12s %6.2fs  %d ok, %d failed' % (
+            'in parallel', time.time() - t,
+            len(report.reports) - len(report.failed), len(report.failed))
+    finally:
+        for p, url in servers:
+            p.terminate()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Report latency from the report server, against a fresh report each time
+
+Usage: bench_reportserver.py [options]
+
+Times --requests summary reports on the same period against a mock server
+with --latency: each one from a new TimeReporting, like a timereport.py
+run (without the interpreter startup), then from fogpy.reportserver's
+ReportService once its people and cases are warm, with and without its
+memoized results. Then --concurrent identical requests at once, which
+should be computed only once.
+"""
+
+import datetime as dt
+import logging
+from optparse import OptionParser
+import threading
+import time
+
+from mockserver import MockFogBugz, SyntheticData
+from fogpy.reportserver import ReportService
+from fogpy.timereport import TimeReporting
+
+def timed(func, n):
+    t = time.time()
+    for _ in xrange(n):
+        func()
+    return (time.time() - t) / n
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("--intervals", type='int', default=20000)
+    parser.add_option("--cases", type='int', default=2000)
+    parser.add_option("--latency", type='float', default=.05)
+    parser.add_option("--requests", type='int', default=5)
+    parser.add_option("--concurrent", type='int', default=16)
+    options, args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    server = MockFogBugz(SyntheticData(cases=options.cases,
+                                       intervals=options.intervals),
+                         latency=options.latency).start()
+    start, end = dt.datetime(2011, 3, 1), dt.datetime(2011, 4, 1)
+
+    def fresh():
+        tr = TimeReporting('bench', 'bench', server.base_url, start, end)
+        tr.get_all_hours_per_tag_per_dev()
+        tr.logout()
+    print '%-22s %9.3fms' % ('fresh report',
+                             1000 * timed(fresh, options.requests))
+
+    tr = TimeReporting('bench', 'bench', server.base_url)
+    service = ReportService(tr, result_ttl=0, refresh=0)
+    report = lambda: service.report(start, end)
+    report()
+    print '%-22s %9.3fms' % ('warm, recomputed',
+                             1000 * timed(report, options.requests))
+    service.results.ttl = 60.
+    report()
+    print '%-22s %9.3fms' % ('warm, memoized',
+                             1000 * timed(report, options.requests))
+
+    service.results.clear()
+    requests = server.snapshot().get('requests', 0)
+    threads = [threading.Thread(target=report)
+               for _ in xrange(options.concurrent)]
+    t = time.time()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    print '%-22s %9.3fms %d API requests, %d coalesced' % (
+        '%d concurrent' % options.concurrent, 1000 * (time.time() - t),
+        server.snapshot().get('requests', 0) - requests,
+        service.results.coalesced)
+    tr.logout()
+    server.shutdown()
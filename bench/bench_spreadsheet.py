@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Time and peak memory of writing large details sheets
+
+Usage: bench_spreadsheet.py [options]
+
+For each number of rows in --rows (comma separated) and each format, a
+fresh process writes that many synthetic detail rows to a temporary file,
+and reports the time it took and how much its peak memory grew. "xlwt" is
+how sheets used to be written, every cell kept in memory until saved; it
+only runs while the rows fit on one sheet.
+"""
+
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+import resource
+import tempfile
+import time
+
+import xlwt
+
+from fogpy.spreadsheet import XlsWorkbook, XlsxWorkbook
+
+HEADER = [u"date", u"time", u"bug_num", u"title", u"dev_name", u"hours",
+          u"project", u"tag", u"url", u"type"]
+
+def maxrss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def detail_rows(n):
+    for i in xrange(n):
+        yield [u'2011-%02d-%02d' % (i % 12 + 1, i % 28 + 1),
+               u'%02d:%02d:00Z' % (i % 24, i % 60), i % 5000,
+               u'Case number %d with a title' % (i % 5000),
+               u'Developer %d' % (i % 20), (i % 17) / 4.,
+               u'Project %d' % (i % 7), u'tag%d' % (i % 12),
+               u'https://example.fogbugz.com/default.asp?%d' % (i % 5000),
+               u'timesheet']
+
+def write_xlwt(f, n):
+    wb = xlwt.Workbook(encoding='utf8')
+    ws = wb.add_sheet(u'Hours details')
+    for col, cell in enumerate(HEADER):
+        ws.write(0, col, cell)
+    for row, cells in enumerate(detail_rows(n)):
+        for col, cell in enumerate(cells):
+            ws.write(row + 1, col, cell)
+    wb.save(f)
+
+def write_streamed(workbook_class):
+    def write(f, n):
+        wb = workbook_class(f)
+        ws = wb.add_sheet(u'Hours details')
+        ws.write_row(HEADER, True)
+        for cells in detail_rows(n):
+            ws.write_row(cells)
+        wb.close()
+    return write
+
+WRITERS = [('xlwt', write_xlwt, 65535),
+           ('xls', write_streamed(XlsWorkbook), None),
+           ('xlsx', write_streamed(XlsxWorkbook), None)]
+
+def run(write, n, out):
+    before = maxrss_mb()
+    with tempfile.TemporaryFile() as f:
+        t = time.time()
+        write(f, n)
+        seconds = time.time() - t
+        f.seek(0, 2)
+        size = f.tell()
+    out.put((seconds, maxrss_mb() - before, size))
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("--rows", default='10000,50000,200000,1000000')
+    parser.add_option("--formats", default=','.join(w[0] for w in WRITERS))
+    options, args = parser.parse_args()
+    formats = options.formats.split(',')
+
+    print '%-6s %9s %9s %12s %12s %10s' % (
+        'format', 'rows', 'time', 'us/row', 'peak +MB', 'file MB')
+    for n in [int(n) for n in options.rows.split(',')]:
+        for name, write, max_rows in WRITERS:
+            if name not in formats or (max_rows and n > max_rows):
+                continue
+            out = Queue()
+            p = Process(target=run, args=(write, n, out))
+            p.start()
+            seconds, peak, size = out.get()
+            p.join()
+            print '%-6s %9d %8.2fs %12.1f %12.1f %10.1f' % (
+                name, n, seconds, 1e6 * seconds / n, peak, size / 1048576.)
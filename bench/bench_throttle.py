@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Throughput of many concurrent API calls against an overloaded server
+
+Usage: bench_throttle.py [options]
+
+Runs --calls listPeople calls, --workers at a time, against a mock server
+serving at most --capacity requests at once (503 beyond that) with
+--error-rate random failures, once with a fixed concurrency and no
+retries, and once with the default adaptive limiter and backoff. The
+server's capacity is capacity / latency requests per second.
+"""
+
+import logging
+from optparse import OptionParser
+import time
+
+from mockserver import MockFogBugz, SyntheticData
+from fogpy.fogbugzapi import AsyncFogBugzAPI
+from fogpy.throttle import AdaptiveLimiter, Backoff
+
+def run(options, limiter=None, backoff=None):
+    server = MockFogBugz(SyntheticData(people=options.people),
+                         latency=options.latency, capacity=options.capacity,
+                         error_rate=options.error_rate,
+                         retry_after=options.retry_after).start()
+    api = AsyncFogBugzAPI(server.base_url, 'bench', 'bench',
+                          max_in_flight=options.workers, limiter=limiter,
+                          backoff=backoff)
+    t = time.time()
+    results = [api.call_async('listPeople') for _ in xrange(options.calls)]
+    failed = 0
+    for r in results:
+        try:
+            r.get(timeout=1e9)
+        except Exception:
+            failed += 1
+    seconds = time.time() - t
+    api.logout()
+    server.shutdown()
+    stats = server.snapshot()
+    return {'seconds': seconds, 'calls/s': options.calls / seconds,
+            'failed': failed, 'rejected': stats.get('rejected', 0),
+            'server errors': stats.get('failed', 0),
+            'requests': stats.get('requests', 0),
+            'final limit': api.limiter.limit}
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("--calls", type='int', default=2000)
+    parser.add_option("--workers", type='int', default=32)
+    parser.add_option("--people", type='int', default=20)
+    parser.add_option("--latency", type='float', default=.02)
+    parser.add_option("--capacity", type='int', default=8)
+    parser.add_option("--error-rate", type='float', default=.01)
+    parser.add_option("--retry-after", type='int', default=None)
+    options, args = parser.parse_args()
+    logging.disable(logging.ERROR)
+
+    print 'server capacity: %.0f calls/s' % (options.capacity
+                                             / options.latency)
+    fixed = AdaptiveLimiter(max_limit=options.workers, decrease=1.,
+                            latency_factor=float('inf'))
+    for name, kwargs in [
+            ('fixed, no retries', {'limiter': fixed,
+                                   'backoff': Backoff(retries=0)}),
+            ('fixed, retries', {'limiter': fixed}),
+            ('adaptive', {})]:
+        r = run(options, **kwargs)
+        print ('%-18s %6.2fs %7.1f calls/s %5d failed %6d rejected '
+               '%4d errors %6d requests  limit %.1f'
+               % (name, r['seconds'], r['calls/s'], r['failed'],
+                  r['rejected'], r['server errors'], r['requests'],
+                  r['final limit']))
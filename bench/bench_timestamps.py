@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""Compare parse_timestamps with parsing each interval's dates with iso8601
+
+Usage: bench_timestamps.py [number of intervals]
+"""
+
+import random
+import sys
+import time
+
+import iso8601
+
+from fogpy.entries import parse_timestamps
+
+def synthetic(n):
+    rnd = random.Random(42)
+    start = 1300000000
+    for _ in xrange(n):
+        start += rnd.randrange(3600)
+        end = start + rnd.randrange(1, 4 * 3600)
+        yield tuple(time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts))
+                    for ts in (start, end))
+
+def iso8601_hours(intervals):
+    return [(iso8601.parse_date(end) - iso8601.parse_date(start)
+             ).total_seconds() / 3600. for start, end in intervals]
+
+def batch_hours(intervals):
+    starts = parse_timestamps([start for start, end in intervals])
+    ends = parse_timestamps([end for start, end in intervals])
+    return [(end - start) / 3600. for start, end in zip(starts, ends)]
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    intervals = list(synthetic(n))
+    results = []
+    for func in (iso8601_hours, batch_hours):
+        t = time.time()
+        results.append(func(intervals))
+        seconds = time.time() - t
+        print '%-14s %.3fs, %.2f us/interval' % (func.__name__, seconds,
+                                                 seconds * 1e6 / n)
+    assert results[0] == results[1]
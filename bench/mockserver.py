@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+"""Local stand-in for the FogBugz api.asp endpoint, serving synthetic data
+
+Usage: mockserver.py [options]
+
+Implements logon, logoff, listPeople, search (including max and
+ixBug:"N..M" ranges, in ixBug order) and listIntervals well enough for
+fogpy, over HTTP/1.1 keep-alive with gzip, streaming its responses so
+that even millions of intervals don't need to be held in memory. Every
+request and byte sent is counted in MockFogBugz.stats.
+
+Faults can be injected: with a capacity, requests beyond that many in
+progress are turned away with a 503 (and Retry-After, if set), and a
+fraction of requests (error_rate) fails with a 500 or a dropped
+connection.
+"""
+
+import BaseHTTPServer
+import calendar
+from optparse import OptionParser
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+from xml.sax.saxutils import escape
+import zlib
+
+def _epoch(timestamp):
+    return calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+
+def _iso(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+class SyntheticData(object):
+    """Deterministic people, cases and intervals, computed on demand"""
+    def __init__(self, people=20, cases=5000, tags=30, projects=5,
+                 intervals=10000, start='2011-01-01T00:00:00Z',
+                 end='2012-01-01T00:00:00Z'):
+        self.people, self.cases, self.tags = people, cases, tags
+        self.projects, self.intervals = projects, intervals
+        self.start, self.end = _epoch(start), _epoch(end)
+        self.spacing = float(self.end - self.start) / max(intervals, 1)
+        # fields changed by the edit command, per ixBug
+        self.edits = {}
+
+    def person(self, ix):
+        return {'ixPerson': ix, 'sFullName': 'Person %d' % ix,
+                'sEmail': 'person%d@example.com' % ix}
+
+    def case(self, ix):
+        tags = ['tag%d' % (ix * 7 % self.tags)]
+        if ix % 17 == 0:
+            tags = []
+        elif ix % 23 == 0:
+            tags.append('tag%d' % ((ix * 7 + 1) % self.tags))
+        resolved = self.resolved(ix)
+        case = {
+            'ixBug': ix,
+            'sTitle': u'Case %d <& "caf\xe9">' % ix,
+            'sProject': 'Project %d' % (ix % self.projects),
+            'tags': tags,
+            'dtResolved': _iso(resolved) if resolved else '',
+            'dtLastUpdated': _iso(resolved or self.start + ix),
+            'hrsElapsedExtra': (ix % 5) * .5 if resolved else 0,
+            'ixPersonResolvedBy': 0 if ix % 11 == 0 or not resolved
+                                  else 1 + ix % self.people,
+            'ixPerson': 1 + ix % self.people,
+        }
+        case.update(self.edits.get(ix, {}))
+        return case
+
+    def resolved(self, ix):
+        """One case in three is resolved, spread over the data's range"""
+        if ix % 3:
+            return None
+        return self.start + (ix * 7919 * 3600) % (self.end - self.start)
+
+    def interval(self, n):
+        start = int(self.start + n * self.spacing)
+        return {
+            'ixInterval': n + 1,
+            'ixPerson': 1 + n % self.people,
+            'ixBug': 1 + (n * 7919) % self.cases,
+            'dtStart': _iso(start),
+            'dtEnd': _iso(start + 1800 + (n % 5) * 600),
+        }
+
+    def intervals_between(self, start, end):
+        first = max(0, int((start - self.start) / self.spacing))
+        for n in xrange(first, self.intervals):
+            i = self.interval(n)
+            i_start = _epoch(i['dtStart'])
+            if i_start >= end:
+                break
+            if i_start >= start:
+                yield i
+
+def element(name, fields):
+    parts = ['<%s>' % name]
+    for k, v in fields.iteritems():
+        if k == 'tags':
+            v = ''.join('<tag>%s</tag>' % escape(t) for t in v)
+        elif isinstance(v, basestring):
+            v = escape(v)
+        parts.append('<%s>%s</%s>' % (k, v, k))
+    parts.append('</%s>' % name)
+    return u''.join(parts).encode('utf8')
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def do_GET(self):
+        args = dict(urlparse.parse_qsl(urlparse.urlsplit(self.path).query))
+        cmd = args.get('cmd', '')
+        self.server.count('requests')
+        if not self.server.enter():
+            self.server.count('rejected')
+            self.send_error_status(503)
+            return
+        try:
+            if self.server.fail():
+                self.server.count('failed')
+                if random.random() < .5:
+                    self.send_error_status(500)
+                else:
+                    self.close_connection = 1
+                return
+            self.server.count('cmd:' + cmd)
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            self.handle_cmd(cmd, args)
+        finally:
+            self.server.leave()
+
+    def send_error_status(self, status):
+        self.send_response(status)
+        if status == 503 and self.server.retry_after is not None:
+            self.send_header('Retry-After', str(self.server.retry_after))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def handle_cmd(self, cmd, args):
+        if cmd == 'logon':
+            body = iter(['<token>%s</token>' % self.server.new_token()])
+        elif not self.server.valid_token(args.get('token')):
+            body = iter(['<error code="3">Not logged on</error>'])
+        elif cmd == 'logoff':
+            body = iter([''])
+        elif hasattr(self, 'cmd_' + cmd):
+            body = getattr(self, 'cmd_' + cmd)(args)
+        else:
+            body = iter(['<error code="0">Unknown command</error>'])
+        self.send_body(body)
+
+    def send_body(self, body):
+        gzip = 'gzip' in (self.headers.get('accept-encoding') or '')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        if gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+
+        z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        if not gzip:
+            z = None
+        parts = ['<?xml version="1.0" encoding="UTF-8"?><response>']
+        for part in body:
+            parts.append(part)
+            if len(parts) >= 256:
+                self.send_data(''.join(parts), z)
+                parts = []
+        parts.append('</response>')
+        self.send_data(''.join(parts), z)
+        if z is not None:
+            self.write_chunk(z.flush())
+        self.write_chunk('')
+
+    def send_data(self, data, z):
+        if z is not None:
+            data = z.compress(data)
+        if data:
+            self.write_chunk(data)
+
+    def write_chunk(self, data):
+        self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+        self.server.count('bytes', len(data))
+
+    def cmd_listPeople(self, args):
+        data = self.server.data
+        yield '<people>'
+        for ix in xrange(1, data.people + 1):
+            yield element('person', data.person(ix))
+        yield '</people>'
+
+    def cmd_listIntervals(self, args):
+        data = self.server.data
+        yield '<intervals>'
+        for i in data.intervals_between(_epoch(args['dtStart']),
+                                        _epoch(args['dtEnd'])):
+            yield element('interval', i)
+        yield '</intervals>'
+
+    def cmd_search(self, args):
+        data = self.server.data
+        q = args.get('q', '')
+        bug_ids = [int(b) for b in re.findall(r'ixBug:(\d+)', q, re.I)]
+        resolved = re.search(r'resolved:"([\d/]+)\.\.([\d/]+)"', q)
+        updated = re.search(r'\bedited:"([\d/]+)\.\."', q)
+        if bug_ids:
+            cases = (data.case(ix) for ix in bug_ids
+                     if 1 <= ix <= data.cases)
+        elif resolved:
+            start = self._day(resolved.group(1))
+            end = self._day(resolved.group(2)) + 86400
+            cases = (data.case(ix) for ix in xrange(1, data.cases + 1)
+                     if start <= (data.resolved(ix) or 0) < end)
+        elif updated:
+            since = self._day(updated.group(1))
+            cases = (c for c in (data.case(ix)
+                                 for ix in xrange(1, data.cases + 1))
+                     if _epoch(c['dtLastUpdated']) >= since)
+        else:
+            cases = (data.case(ix) for ix in xrange(1, data.cases + 1))
+        ix_range = re.search(r'ixBug:"(\d+)\.\.(\d*)"', q, re.I)
+        if ix_range:
+            low = int(ix_range.group(1))
+            high = int(ix_range.group(2) or data.cases)
+            cases = (c for c in cases if low <= c['ixBug'] <= high)
+        yield '<cases>'
+        for n, c in enumerate(cases):
+            if 'max' in args and n >= int(args['max']):
+                break
+            yield element('case', c)
+        yield '</cases>'
+
+    def cmd_edit(self, args):
+        data = self.server.data
+        ix = int(args.get('ixBug') or 0)
+        if not 1 <= ix <= data.cases:
+            yield '<error code="7">Case %d does not exist</error>' % ix
+            return
+        changes = {}
+        if 'sTags' in args:
+            changes['tags'] = [t for t in args['sTags'].decode('utf8')
+                               .split(',') if t]
+        data.edits.setdefault(ix, {}).update(changes)
+        self.server.count('edited')
+        yield '<case ixBug="%d" operations="edit"></case>' % ix
+
+    def _day(self, mdy):
+        return calendar.timegm(time.strptime(mdy, '%m/%d/%Y'))
+
+class MockFogBugz(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, data=None, latency=0., host='127.0.0.1', port=0,
+                 capacity=None, error_rate=0., retry_after=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), MockHandler)
+        self.data = data or SyntheticData()
+        self.latency = latency
+        self.capacity, self.error_rate = capacity, error_rate
+        self.retry_after = retry_after
+        self.active = self.peak_active = 0
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+        self.tokens = set()
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d/api.asp' % self.server_address
+
+    def count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + n
+
+    def enter(self):
+        """Count a request in progress, unless we're at capacity"""
+        with self._stats_lock:
+            if self.capacity is not None and self.active >= self.capacity:
+                return False
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+            return True
+
+    def leave(self):
+        with self._stats_lock:
+            self.active -= 1
+
+    def fail(self):
+        return self.error_rate and random.random() < self.error_rate
+
+    def new_token(self):
+        with self._stats_lock:
+            token = 'mocktoken%d' % self.stats.get('cmd:logon', 0)
+            self.tokens.add(token)
+        return token
+
+    def valid_token(self, token):
+        with self._stats_lock:
+            return token in self.tokens
+
+    def expire_tokens(self):
+        """Make every token given out so far invalid"""
+        with self._stats_lock:
+            self.tokens.clear()
+
+    def snapshot(self):
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def start(self):
+        """Serve from a background thread"""
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # clients going away mid-response are expected, e.g. abandoned
+        # streaming calls
+        pass
+
+def add_data_options(parser):
+    parser.add_option("--people", type='int', default=20)
+    parser.add_option("--cases", type='int', default=5000)
+    parser.add_option("--tags", type='int', default=30)
+    parser.add_option("--intervals", default='10000')
+    parser.add_option("--latency", type='float', default=0.,
+                      help="Seconds added to every response [%default]")
+    parser.add_option("--capacity", type='int', default=None,
+                      help="Requests served at once, the others get a 503 "
+                           "[%default]")
+    parser.add_option("--error-rate", type='float', default=0.,
+                      help="Fraction of requests failing with a 500 or a "
+                           "dropped connection [%default]")
+    parser.add_option("--retry-after", type='int', default=None,
+                      help="Retry-After seconds sent with 503s [%default]")
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    add_data_options(parser)
+    parser.add_option("--port", type='int', default=8000)
+    options, args = parser.parse_args()
+    server = MockFogBugz(SyntheticData(options.people, options.cases,
+                                       options.tags,
+                                       intervals=int(options.intervals)),
+                         latency=options.latency, port=options.port,
+                         capacity=options.capacity,
+                         error_rate=options.error_rate,
+                         retry_after=options.retry_after)
+    print 'Serving on', server.base_url
+    server.serve_forever()
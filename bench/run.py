@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""Benchmark fogpy's time reporting against a local mock FogBugz
+
+Usage: run.py [options]
+
+For each number of intervals in --intervals (comma separated), a fresh
+process runs every stage of a report against bench/mockserver.py, and
+records per stage its wall time, API round trips, bytes sent by the
+server and how much it raised the process' peak memory: a stage using less
+than an earlier one shows 0. Results are printed and saved as JSON to
+--output, to compare them across commits.
+"""
+
+import datetime as dt
+import json
+import logging
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+import os
+import resource
+import subprocess
+import tempfile
+import time
+
+from mockserver import MockFogBugz, SyntheticData, add_data_options
+from fogpy.fogbugzapi import FogBugzAPI
+from fogpy.timereport import TimeReporting
+
+def maxrss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+class StageTimer(object):
+    def __init__(self, server):
+        self.server = server
+        self.results = []
+
+    def run(self, name, func, *args, **kwargs):
+        before = self.server.snapshot()
+        rss = maxrss_mb()
+        t = time.time()
+        value = func(*args, **kwargs)
+        seconds = time.time() - t
+        after = self.server.snapshot()
+        self.results.append({
+            'stage': name,
+            'seconds': round(seconds, 4),
+            'requests': after.get('requests', 0) - before.get('requests', 0),
+            'bytes': after.get('bytes', 0) - before.get('bytes', 0),
+            'connections': (after.get('connections', 0)
+                            - before.get('connections', 0)),
+            'rss_growth_mb': round(maxrss_mb() - rss, 1),
+        })
+        return value
+
+def api_calls(url, n):
+    api = FogBugzAPI(url, 'bench', 'bench')
+    for _ in xrange(n):
+        api.call('listPeople')
+    api.logout()
+
+def write_to_tempfile(func, *args):
+    with tempfile.TemporaryFile() as f:
+        func(f, *args)
+
+def run_benchmark(options, n_intervals, out):
+    data = SyntheticData(options.people, options.cases, options.tags,
+                         intervals=n_intervals)
+    server = MockFogBugz(data, latency=options.latency,
+                         capacity=options.capacity,
+                         error_rate=options.error_rate,
+                         retry_after=options.retry_after).start()
+    url = server.base_url
+    start = dt.datetime(2011, 1, 1)
+    end = dt.datetime(2012, 1, 1)
+    stages = StageTimer(server)
+
+    stages.run('api_calls', api_calls, url, options.api_calls)
+    tr = stages.run('login', TimeReporting, 'bench', 'bench', url,
+                    start, end, **options.report_kwargs)
+    stages.run('fetch', tr.get_entries)
+    stages.run('summary', tr.get_all_hours_per_tag_per_dev)
+    details = stages.run('details', tr.get_hours_details)
+    stages.run('csv_cumulative', write_to_tempfile, tr.write_csv_cumulative)
+    stages.run('csv_detailed', write_to_tempfile, tr.write_csv_detailed)
+    stages.run('xls', write_to_tempfile, tr.write_xls_report, True)
+    stages.run('xlsx', write_to_tempfile, tr.write_xlsx_report, True)
+    tr.logout()
+    server.shutdown()
+    out.put({'intervals': n_intervals, 'entries': len(tr.entries),
+             'detail_rows': len(details), 'stages': stages.results})
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    add_data_options(parser)
+    parser.add_option("--api-calls", dest="api_calls", type='int',
+                      default=100,
+                      help="Number of calls for the api_calls stage "
+                           "[%default]")
+    parser.add_option("--shard-days", dest="shard_days", type='int',
+                      default=None)
+    parser.add_option("--workers", dest="max_workers", type='int', default=4)
+    parser.add_option("-o", "--output", dest="output",
+                      default='bench_results.json',
+                      help="JSON file to save results to [%default]")
+    options, args = parser.parse_args()
+    options.report_kwargs = {'shard_days': options.shard_days,
+                             'max_workers': options.max_workers}
+    logging.disable(logging.WARNING)
+
+    results = {
+        'revision': git_revision(),
+        'date': dt.datetime.utcnow().isoformat() + 'Z',
+        'params': {'people': options.people, 'cases': options.cases,
+                   'tags': options.tags, 'latency': options.latency,
+                   'capacity': options.capacity,
+                   'error_rate': options.error_rate,
+                   'shard_days': options.shard_days,
+                   'workers': options.max_workers},
+        'runs': [],
+    }
+    for n in [int(n) for n in options.intervals.split(',')]:
+        out = Queue()
+        p = Process(target=run_benchmark, args=(options, n, out))
+        p.start()
+        run = out.get()
+        p.join()
+        results['runs'].append(run)
+        print '%d intervals, %d detail rows' % (n, run['detail_rows'])
+        for s in run['stages']:
+            print ('  %(stage)-15s %(seconds)8.3fs %(requests)6d requests '
+                   '%(bytes)10d bytes %(rss_growth_mb)+8.1f MB' % s)
+
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print 'Results saved to', options.output
@@ -0,0 +1,193 @@
+"""Column-wise storage for hours entries
+
+An EntryTable keeps one row per timesheet interval or elapsed-time case in
+flat arrays, rather than one Python object per row, and does its
+aggregation on integer keys. If numpy is installed, aggregation is done on
+views of those arrays without any per-row Python code.
+"""
+
+from array import array
+import calendar
+from collections import defaultdict
+from itertools import izip
+import time
+
+import iso8601
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TIMESHEET, ELAPSED = 0, 1
+ENTRY_TYPES = ('timesheet', 'elapsed')
+
+# stored in place of a missing date, e.g. dtResolved of a reopened case
+NO_DATE = -2 ** 62
+
+def parse_timestamps(timestamps):
+    """FogBugz timestamp strings to an array of seconds since the epoch
+
+    FogBugz always sends YYYY-MM-DDTHH:MM:SSZ, which is converted by
+    slicing, with one timegm call per distinct hour. Anything else, out of
+    range fields included, goes through iso8601.
+    """
+    epochs = array('l')
+    append = epochs.append
+    hours = {}
+    for ts in timestamps:
+        if ts and len(ts) == 20 and ts[19] == 'Z' and ts[10] == 'T':
+            try:
+                try:
+                    base = hours[ts[:13]]
+                except KeyError:
+                    base = hours[ts[:13]] = _hour_epoch(ts)
+                minute, second = int(ts[14:16]), int(ts[17:19])
+                if 0 <= minute < 60 and 0 <= second < 60:
+                    append(base + minute * 60 + second)
+                    continue
+            except ValueError:
+                pass
+        append(_parse_timestamp(ts))
+    return epochs
+
+def _hour_epoch(ts):
+    """Seconds since the epoch of the hour of ts, which timegm would roll
+    over into the next month, day or hour if it's out of range"""
+    year, month, day, hour = (int(ts[:4]), int(ts[5:7]), int(ts[8:10]),
+                              int(ts[11:13]))
+    if not (1 <= month <= 12 and 0 <= hour < 24
+            and 1 <= day <= calendar.monthrange(year, month)[1]):
+        raise ValueError("%s out of range" % ts)
+    return calendar.timegm((year, month, day, hour, 0, 0))
+
+def _parse_timestamp(timestamp):
+    if not timestamp:
+        return NO_DATE
+    return calendar.timegm(iso8601.parse_date(timestamp).utctimetuple())
+
+def to_epoch(timestamp):
+    """FogBugz timestamp string to seconds since the epoch"""
+    return parse_timestamps((timestamp, ))[0]
+
+def from_epoch(seconds):
+    """Seconds since the epoch to a FogBugz timestamp string"""
+    if seconds == NO_DATE:
+        return None
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+class Interner(object):
+    """Maps values to small integer codes, and back"""
+    def __init__(self, values=()):
+        self.values = []
+        self.codes = {}
+        for v in values:
+            self.code(v)
+
+    def code(self, value):
+        try:
+            return self.codes[value]
+        except KeyError:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+            return code
+
+    def __getitem__(self, code):
+        return self.values[code]
+
+    def __len__(self):
+        return len(self.values)
+
+class EntryTable(object):
+    """Hours entries stored as parallel arrays
+
+    date is in seconds since the epoch, dev and bug are ixPerson and ixBug,
+    type is TIMESHEET or ELAPSED.
+    """
+    COLUMNS = ('date', 'bug', 'dev', 'hours', 'type')
+
+    def __init__(self):
+        self.date = array('l')
+        self.bug = array('l')
+        self.dev = array('l')
+        self.hours = array('d')
+        self.type = array('B')
+
+    def __len__(self):
+        return len(self.hours)
+
+    def append(self, date, bug_id, dev_id, hours, entry_type):
+        self.date.append(date)
+        self.bug.append(bug_id)
+        self.dev.append(dev_id)
+        self.hours.append(hours)
+        self.type.append(entry_type)
+
+    def rows(self):
+        """Iterate over (date, bug, dev, hours, type) tuples"""
+        return izip(self.date, self.bug, self.dev, self.hours, self.type)
+
+    def bug_ids(self):
+        return set(self.bug)
+
+    def sum_hours(self, *columns):
+        """Group by the given columns, returning {(values...): hours}"""
+        if numpy is not None and len(self):
+            return self._numpy_sum_hours(columns)
+        return self._python_sum_hours(columns)
+
+    def _python_sum_hours(self, columns):
+        sums = defaultdict(float)
+        if len(columns) == 1:
+            for k, h in izip(getattr(self, columns[0]), self.hours):
+                sums[(k, )] += h
+        else:
+            keys = izip(*[getattr(self, c) for c in columns])
+            for k, h in izip(keys, self.hours):
+                sums[k] += h
+        return sums
+
+    def _numpy_sum_hours(self, columns):
+        # number each column's values from 0, either by offsetting them
+        # when their range is small or by ranking the distinct values, and
+        # combine those numbers into a single int64 key per row
+        key = numpy.zeros(len(self), dtype=numpy.int64)
+        decoders = []
+        key_range = 1
+        for c in columns:
+            col = numpy.frombuffer(getattr(self, c),
+                                   dtype=getattr(self, c).typecode)
+            lo, hi = int(col.min()), int(col.max())
+            if hi - lo < len(self):
+                values, codes, size = None, col - lo, hi - lo + 1
+            else:
+                values, codes = numpy.unique(col, return_inverse=True)
+                size = len(values)
+            key_range *= size
+            if key_range >= 2 ** 63:
+                return self._python_sum_hours(columns)
+            key = key * size + codes
+            decoders.append((lo, values, size))
+
+        hours = numpy.frombuffer(self.hours, dtype='d')
+        if key_range <= 4 * len(self):
+            # few enough possible keys to sum into one bin per key
+            keys = numpy.flatnonzero(numpy.bincount(key, minlength=key_range))
+            sums = numpy.bincount(key, weights=hours,
+                                  minlength=key_range)[keys]
+        else:
+            # sort the keys and sum each run of equal keys
+            order = numpy.argsort(key)
+            key = key[order]
+            starts = numpy.flatnonzero(numpy.concatenate(
+                ([True], key[1:] != key[:-1])))
+            sums = numpy.add.reduceat(hours[order], starts)
+            keys = key[starts]
+
+        decoded = []
+        for lo, values, size in reversed(decoders):
+            codes = keys % size
+            keys = keys // size
+            decoded.append((codes + lo if values is None
+                            else values[codes]).tolist())
+        decoded.reverse()
+        return dict(izip(izip(*decoded), sums.tolist()))
@@ -1,8 +1,24 @@
+from collections import defaultdict, namedtuple
 from cStringIO import StringIO
+import errno
+import httplib
 import logging
 from lxml import etree
+from multiprocessing.pool import ThreadPool
+import Queue
+import socket
+import sys
 import threading
+import time
 import urllib
+import urlparse
+import zlib
+
+from fogpy.metrics import CallMetrics
+from fogpy.respcache import ReplayMissError, is_cacheable
+from fogpy.throttle import (TRANSIENT_STATUSES, UNPROCESSED_STATUSES,
+                            AdaptiveLimiter, Backoff, retry_after_seconds)
+from fogpy.waiting import wait_for
 
 l = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -13,11 +29,225 @@ class NotLoggedOnError(Exception):
     def __unicode__(self):
         return self.msg
 
+class TransientError(RuntimeError):
+    """The server stayed overloaded or unreachable through every retry"""
+    def __init__(self, msg):
+        RuntimeError.__init__(self, msg)
+        self.msg = msg
+    def __unicode__(self):
+        return self.msg
+
+def is_idempotent(cmd):
+    """Commands that can be sent again whatever became of the first try"""
+    return is_cacheable(cmd) or cmd in ('logon', 'logoff')
+
+def decode_body(body, encoding):
+    """Decompress a response body according to its Content-Encoding"""
+    encoding = (encoding or '').strip().lower()
+    if encoding == 'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        # some servers send a raw deflate stream without the zlib header
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+class DecodingReader(object):
+    """File-like wrapper decompressing a response as it is being read"""
+    def __init__(self, fp, encoding):
+        self.fp = fp
+        encoding = (encoding or '').strip().lower()
+        if encoding == 'gzip':
+            self._z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._z = zlib.decompressobj()
+        else:
+            self._z = None
+        self._raw_fallback = encoding == 'deflate'
+        self.raw_bytes = self.bytes = 0
+
+    def read(self, size=-1):
+        data = self._read(size)
+        self.bytes += len(data)
+        return data
+
+    def _read(self, size):
+        if self._z is None:
+            data = self.fp.read(size)
+            self.raw_bytes += len(data)
+            return data
+        while True:
+            chunk = self.fp.read(size)
+            self.raw_bytes += len(chunk)
+            if not chunk:
+                return self._z.flush()
+            try:
+                data = self._z.decompress(chunk)
+            except zlib.error:
+                if not self._raw_fallback:
+                    raise
+                # raw deflate stream without the zlib header
+                self._z = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = self._z.decompress(chunk)
+            self._raw_fallback = False
+            if data:
+                return data
+
+class TeeReader(object):
+    """File-like wrapper keeping a copy of everything read through it"""
+    def __init__(self, fp):
+        self.fp = fp
+        self.chunks = []
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.chunks.append(data)
+        return data
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+class ConnectionPool(object):
+    """Pool of persistent HTTP/1.1 connections to the host of base_url
+
+    At most `size` idle connections are kept around; connections idle for
+    longer than `idle_timeout` seconds are closed instead of being reused.
+    """
+    def __init__(self, base_url, size=4, idle_timeout=60., timeout=None):
+        parts = urlparse.urlsplit(base_url)
+        if parts.scheme == 'https':
+            self._conn_class = httplib.HTTPSConnection
+        else:
+            self._conn_class = httplib.HTTPConnection
+        self.host, self.port = parts.hostname, parts.port
+        self.path = parts.path or '/'
+        self.size, self.idle_timeout = size, idle_timeout
+        self.timeout = timeout
+        self.connections_opened = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        with self._lock:
+            self.connections_opened += 1
+        return self._conn_class(self.host, self.port, **kwargs)
+
+    def get(self):
+        """Returns (connection, reused)"""
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                last_used, conn = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._new_connection(), False
+
+    def put(self, conn):
+        """Give back a connection whose response has been fully read"""
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((time.time(), conn))
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for last_used, conn in idle:
+            conn.close()
+
+    def urlopen(self, path, headers, resend=True):
+        """GET path, returning (connection, response)
+
+        A reused connection may have been closed by the server in the
+        meantime, in which case the request is sent again once on a new
+        one. If resend is false, as for requests that mustn't go through
+        twice, that's only done when the server can't have processed it:
+        it couldn't be sent, or the connection was closed without a word.
+        """
+        conn, reused = self.get()
+        while True:
+            sent = False
+            try:
+                conn.request('GET', path, headers=headers)
+                sent = True
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if not (reused and (resend or not sent
+                                    or _closed_before_status(e))):
+                    raise
+                l.debug('stale connection to %s, reconnecting' % self.host)
+                conn, reused = self._new_connection(), False
+
+def _closed_before_status(e):
+    """Whether e is the server closing the connection before any response"""
+    if isinstance(e, httplib.BadStatusLine):
+        # how older and newer httplibs say nothing came back
+        return e.line == repr('') or e.line.startswith('No status line')
+    return isinstance(e, socket.error) and e.errno == errno.ECONNRESET
+
+class Prefetch(threading.Thread):
+    """Runs func(*args) in a thread of its own; get() waits for the result"""
+    def __init__(self, func, *args):
+        super(Prefetch, self).__init__()
+        self.daemon = True
+        self.func, self.args = func, args
+        self.result = self.exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def get(self):
+        self.join()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
 class FogBugzAPI(object):
-    def __init__(self, base_url, username, password):
+    """A FogBugz API session, which any number of threads can share
+
+    All threads use the same token. When it expires, the first thread to
+    notice logs on again while the others wait for it, and they all retry
+    with the new token.
+
+    Requests in flight are bounded by limiter, and overloaded or failed
+    requests retried after backoff's delay; see fogpy.throttle.
+    """
+    def __init__(self, base_url, username, password, pool_size=4,
+                 idle_timeout=60., compress=True, cache=None, metrics=None,
+                 limiter=None, backoff=None):
+        """cache is an optional fogpy.respcache.ResponseCache"""
         self.base_url = base_url
+        self._token = None
+        self._logon_lock = threading.Lock()
         self.username, self.password = username, password
-        self.login(username, password)
+        self.compress = compress
+        self.cache = cache
+        self.metrics = metrics or CallMetrics()
+        self.objects = IdentityMap(self)
+        self.limiter = limiter or AdaptiveLimiter(max_limit=pool_size)
+        self.backoff = backoff or Backoff()
+        self.pool = ConnectionPool(base_url, size=pool_size,
+                                   idle_timeout=idle_timeout)
+        if self.replaying:
+            l.info('replaying recorded responses, not logging on')
+        else:
+            self.login(username, password)
+
+    @property
+    def replaying(self):
+        return self.cache is not None and self.cache.replay
 
     def login(self, username, password):
         resp = self.call('logon', notoken=True, email=username, 
@@ -26,58 +256,677 @@ class FogBugzAPI(object):
         l.info('%s logon successful'%username)
 
     def logout(self):
-        resp = self.call('logoff')
+        if not self.replaying:
+            resp = self.call('logoff')
+        self.pool.clear()
         l.info('logged out')
 
-    def call(self, *args, **kwargs):
+    def call(self, cmd, notoken=False, **kwargs):
+        token = None if notoken else self._token
         try:
-            return self._call(*args, **kwargs)
+            return self._call(cmd, token, kwargs)
         except NotLoggedOnError:
-            self.login(self.username, self.password)
-            return self._call(*args, **kwargs)
+            if notoken:
+                raise
+            token = self._relogon(cmd, token)
+            return self._call(cmd, token, kwargs)
+
+    def _relogon(self, cmd, stale_token):
+        """Log on again, unless another thread did since stale_token was
+        used, and return the new token"""
+        with self._logon_lock:
+            if self._token == stale_token:
+                self.metrics.record_relogon(cmd)
+                self.login(self.username, self.password)
+            return self._token
+
+    def iter_call(self, cmd, tag='case', notoken=False, **kwargs):
+        """Like call, but streams the response, yielding each `tag` element
+
+        Elements are cleared as soon as the consumer asks for the next one,
+        so memory use doesn't grow with the size of the response. Copy
+        anything you need out of an element before moving on.
+        """
+        token = None if notoken else self._token
+        yielded = False
+        try:
+            for elem in self._iter_call(cmd, tag, token, kwargs):
+                yielded = True
+                yield elem
+        except NotLoggedOnError:
+            if yielded or notoken:
+                raise
+            token = self._relogon(cmd, token)
+            for elem in self._iter_call(cmd, tag, token, kwargs):
+                yield elem
+
+    def search(self, q, cols='ixBug', page_size=1000, prefetch=False):
+        """Yield every case matching q, page_size cases per request
+
+        Pages are walked in ixBug order, each one asking for the cases
+        after the last ixBug of the previous one, so memory use is bounded
+        by the page size whatever the number of cases. Without prefetch
+        pages are streamed as with iter_call. With prefetch, each page is
+        parsed whole while the previous one is being consumed; the
+        elements yielded then stay valid.
+        """
+        cols = cols.split(',')
+        if 'ixBug' not in cols:
+            cols.append('ixBug')
+        cols = ','.join(cols)
+        if not prefetch:
+            after = 0
+            while True:
+                count = 0
+                for case in self.iter_call('search', tag='case', max=page_size,
+                                           q=self._page_query(q, after),
+                                           cols=cols):
+                    count += 1
+                    after = int(case.find('ixBug').text)
+                    yield case
+                if count < page_size:
+                    return
 
-    def _call(self, cmd, notoken=False, **kwargs):
+        page = Prefetch(self._search_page, q, cols, page_size, 0)
+        while page is not None:
+            cases = page.get()
+            page = None
+            if len(cases) == page_size:
+                page = Prefetch(self._search_page, q, cols, page_size,
+                                int(cases[-1].find('ixBug').text))
+            for case in cases:
+                yield case
+
+    def edit_many(self, edits, workers=8, retries=2, dry_run=False):
+        """Run many (ixBug, changes) edits concurrently; see BulkEdit"""
+        return BulkEdit(self, workers=workers, retries=retries,
+                        dry_run=dry_run).run(edits)
+
+    def _search_page(self, q, cols, page_size, after):
+        resp = self.call('search', max=page_size,
+                         q=self._page_query(q, after), cols=cols)
+        return resp.findall('cases/case')
+
+    def _page_query(self, q, after):
+        page = 'ixBug:"%d.." OrderBy:ixBug' % (after + 1)
+        if q.strip() in ('', '""'):
+            return page
+        return '(%s) %s' % (q, page)
+
+    def _url_args(self, cmd, token, kwargs):
         url_args = kwargs.copy() 
         url_args['cmd'] = cmd
-        if not notoken:
-            url_args['token'] = self._token
-        url = self.base_url + '?' + urllib.urlencode(url_args)
-        l.debug('Calling ' + url)
-        resp = urllib.urlopen(url)
-        resp_txt = resp.read()
-        xml_resp = etree.parse(StringIO(resp_txt))
-        if resp.getcode() != 200:
-            msg = "%d error trying to do %s"%(resp.getcode(), cmd)
-            l.error(msg)
-            raise RuntimeError(msg)
-        elif xml_resp.find('error') is not None:
-            msg = "%s error: %s"%(cmd, xml_resp.find('error').text)
-            l.error(msg)
-            l.debug(etree.tostring(xml_resp))
-            if xml_resp.find('error').values()[0] == '3':
-                raise NotLoggedOnError(msg)
-            raise RuntimeError(msg)
+        if token is not None:
+            url_args['token'] = token
+        return url_args
+
+    def _use_cache(self, cmd):
+        return self.cache is not None and is_cacheable(cmd)
+
+    def _loggable_url(self, url_args):
+        url_args = url_args.copy()
+        for secret in ('token', 'password'):
+            if secret in url_args:
+                url_args[secret] = '***'
+        return self.base_url + '?' + urllib.urlencode(url_args)
+
+    def _iter_call(self, cmd, tag, token, kwargs):
+        use_cache = self._use_cache(cmd)
+        body = None
+        if use_cache:
+            body = self.cache.get(cmd, kwargs)
+        timing = {'latency': 0., 'parse_time': 0., 'stream': None}
+        error = None
+        try:
+            if body is not None:
+                stream = timing['stream'] = DecodingReader(StringIO(body),
+                                                           None)
+                for elem in self._iterparse(stream, cmd, tag, timing):
+                    yield elem
+            else:
+                for elem in self._iter_fetch(cmd, tag, token, kwargs,
+                                             use_cache, timing):
+                    yield elem
+        except Exception, e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            stream = timing['stream']
+            self.metrics.record_call(
+                cmd, timing['latency'],
+                nbytes=stream.bytes if stream else 0,
+                wire_bytes=stream.raw_bytes if stream and body is None else 0,
+                parse_time=timing['parse_time'], error=error,
+                cached=body is not None)
+
+    def _iter_fetch(self, cmd, tag, token, kwargs, use_cache, timing):
+        url_args = self._url_args(cmd, token, kwargs)
+        l.debug('Streaming ' + self._loggable_url(url_args))
+        path = self.pool.path + '?' + urllib.urlencode(url_args)
+        conn, resp, timing['latency'] = self._open(cmd, path)
+        complete = False
+        try:
+            if resp.status != 200:
+                msg = "%d error trying to do %s"%(resp.status, cmd)
+                l.error(msg)
+                raise RuntimeError(msg)
+            stream = timing['stream'] = DecodingReader(
+                resp, resp.getheader('content-encoding'))
+            if use_cache:
+                stream = TeeReader(stream)
+            for elem in self._iterparse(stream, cmd, tag, timing):
+                yield elem
+            complete = True
+        finally:
+            if complete and not resp.will_close:
+                self.pool.put(conn)
+            else:
+                conn.close()
+        if use_cache:
+            self.cache.put(cmd, kwargs, stream.getvalue())
+
+    def _iterparse(self, stream, cmd, tag, timing):
+        """Adds time spent parsing, which includes reading the stream, to
+        timing['parse_time']"""
+        events = etree.iterparse(stream, events=('end',), tag=(tag, 'error'))
+        while True:
+            t = time.time()
+            try:
+                event, elem = next(events)
+            except StopIteration:
+                return
+            finally:
+                timing['parse_time'] += time.time() - t
+            if elem.tag == 'error':
+                msg = "%s error: %s"%(cmd, elem.text)
+                l.error(msg)
+                if elem.get('code') == '3':
+                    raise NotLoggedOnError(msg)
+                raise RuntimeError(msg)
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    def _call(self, cmd, token, kwargs):
+        use_cache = self._use_cache(cmd)
+        resp_txt = None
+        if use_cache:
+            resp_txt = self.cache.get(cmd, kwargs)
+        cached = resp_txt is not None
+        latency, wire_bytes, parse_time = 0., 0, 0.
+        error = None
+        try:
+            if cached:
+                status = 200
+            else:
+                url_args = self._url_args(cmd, token, kwargs)
+                l.debug('Calling ' + self._loggable_url(url_args))
+                t = time.time()
+                status, resp_txt, wire_bytes = self._fetch(cmd, url_args)
+                latency = time.time() - t
+            t = time.time()
+            xml_resp = etree.parse(StringIO(resp_txt))
+            parse_time = time.time() - t
 
+            msg = None
+            if status != 200:
+                msg = "%d error trying to do %s"%(status, cmd)
+                error = RuntimeError
+            elif xml_resp.find('error') is not None:
+                msg = "%s error: %s"%(cmd, xml_resp.find('error').text)
+                l.debug(etree.tostring(xml_resp))
+                error = RuntimeError
+                if xml_resp.find('error').get('code') == '3':
+                    error = NotLoggedOnError
+            if error is not None:
+                l.error(msg)
+                raise error(msg)
+        except Exception, e:
+            error = e.__class__
+            raise
+        finally:
+            self.metrics.record_call(cmd, latency,
+                                     nbytes=len(resp_txt or ''),
+                                     wire_bytes=wire_bytes,
+                                     parse_time=parse_time,
+                                     error=error and error.__name__,
+                                     cached=cached)
+
+        if use_cache and not cached:
+            self.cache.put(cmd, kwargs, resp_txt)
         return xml_resp
 
-class FBApiObject(object):
-    """Base object for retrieving and saving stuff through the API"""
-    def __init__(self, base_url=None, username=None, password=None):
-        if base_url is None:
-            # try to get it from a global login
-            self._fbapi = thread.local().fbapi
+    def _headers(self):
+        headers = {'Connection': 'keep-alive'}
+        if self.compress:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        return headers
+
+    def _fetch(self, cmd, url_args):
+        """GET the API with url_args over a pooled connection
+
+        Returns (status, decoded body, bytes received)
+        """
+        path = self.pool.path + '?' + urllib.urlencode(url_args)
+        conn, resp, latency = self._open(cmd, path)
+        body = self._read_and_release(conn, resp)
+        return (resp.status,
+                decode_body(body, resp.getheader('content-encoding')),
+                len(body))
+
+    def _read_and_release(self, conn, resp):
+        try:
+            body = resp.read()
+        except:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
         else:
-            self._fbapi = FogBugzAPI(base_url, username, password)
+            self.pool.put(conn)
+        return body
+
+    def _open(self, cmd, path):
+        """GET path, retrying transient failures, within the limiter
+
+        Returns (connection, response, latency) for the first response
+        with a status that isn't worth retrying. Commands that change
+        something are only retried if the server didn't process them.
+        Nothing goes to the network while replaying.
+        """
+        if self.replaying:
+            raise ReplayMissError("%s can't be replayed" % cmd)
+        idempotent = is_idempotent(cmd)
+        attempt = 0
+        while True:
+            retry_after = status = None
+            self.limiter.acquire()
+            t = time.time()
+            try:
+                conn, resp = self.pool.urlopen(path, self._headers(),
+                                               resend=idempotent)
+            except (httplib.HTTPException, socket.error), e:
+                self.limiter.release(time.time() - t, overloaded=True)
+                failure = '%s: %s' % (e.__class__.__name__, e)
+            else:
+                latency = time.time() - t
+                status = resp.status
+                if status not in TRANSIENT_STATUSES:
+                    self.limiter.release(latency)
+                    return conn, resp, latency
+                self.limiter.release(latency, overloaded=True)
+                retry_after = retry_after_seconds(
+                    resp.getheader('retry-after'))
+                failure = 'status %d' % status
+                try:
+                    self._read_and_release(conn, resp)
+                except (httplib.HTTPException, socket.error):
+                    pass
+            if not (idempotent or status in UNPROCESSED_STATUSES):
+                msg = ("%s failed, and may have gone through: %s"
+                       % (cmd, failure))
+                l.error(msg)
+                raise TransientError(msg)
+            if attempt >= self.backoff.retries:
+                msg = "%s failed after %d attempts: %s" % (cmd, attempt + 1,
+                                                          failure)
+                l.error(msg)
+                raise TransientError(msg)
+            delay = self.backoff.delay(attempt, retry_after)
+            l.warning('%s: %s, retrying in %.2fs' % (cmd, failure, delay))
+            self.metrics.record_retry(cmd)
+            time.sleep(delay)
+            attempt += 1
+
+class AsyncFogBugzAPI(FogBugzAPI):
+    """FogBugzAPI that can also run many calls concurrently
+
+    call_async and submit return a result whose get() waits for and returns
+    the call's result, or raises its exception. At most max_in_flight
+    requests run at the same time; the rest are queued. For example:
+
+        results = api.gather(*[api.call_async('search', q=q) for q in qs])
+    """
+    def __init__(self, base_url, username, password, max_in_flight=8,
+                 **kwargs):
+        kwargs.setdefault('pool_size', max_in_flight)
+        self.max_in_flight = max_in_flight
+        self._workers = None
+        self._workers_lock = threading.Lock()
+        super(AsyncFogBugzAPI, self).__init__(base_url, username, password,
+                                              **kwargs)
+
+    def logout(self):
+        super(AsyncFogBugzAPI, self).logout()
+        self.close()
+
+    def close(self):
+        with self._workers_lock:
+            workers, self._workers = self._workers, None
+        if workers is not None:
+            workers.terminate()
+
+    def submit(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) on one of the worker threads"""
+        with self._workers_lock:
+            if self._workers is None:
+                self._workers = ThreadPool(self.max_in_flight)
+            return self._workers.apply_async(func, args, kwargs)
+
+    def call_async(self, cmd, **kwargs):
+        return self.submit(self.call, cmd, **kwargs)
+
+    def gather(self, *results):
+        """Wait for all results, returning their values in order"""
+        for r in results:
+            wait_for(r.ready, r.wait)
+        return [r.get() for r in results]
+
+EditResult = namedtuple('EditResult', ('bug_id', 'changes', 'ok', 'error',
+                                       'attempts'))
+
+class BulkEdit(object):
+    """Many case edits, run by a few worker threads
+
+    Edits are (ixBug, changes) pairs, changes being arguments of the edit
+    command, e.g. {'sTags': ['ClientA']}; lists are sent comma separated.
+    Edits are taken from the iterable as workers become free, through a
+    queue of at most twice as many edits as workers, so a generator of
+    edits is never read far ahead. An edit that fails with a TransientError
+    is tried again, up to retries more times: as it may have gone through,
+    only do that for edits that set values, e.g. not ones adding an sEvent.
+    In dry_run mode, edits are only logged.
+    """
+    def __init__(self, api, workers=8, retries=2, dry_run=False):
+        self.api = api
+        self.workers, self.retries, self.dry_run = workers, retries, dry_run
+        self.done = 0
+        self._lock = threading.Lock()
+
+    def run(self, edits):
+        """Returns an EditResult per edit, in the order of edits"""
+        tasks = Queue.Queue(2 * self.workers)
+        results = {}
+        threads = [threading.Thread(target=self._work, args=(tasks, results))
+                   for _ in xrange(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        n = 0
+        for n, (bug_id, changes) in enumerate(edits, 1):
+            tasks.put((n, bug_id, changes))
+        for t in threads:
+            tasks.put(None)
+        for t in threads:
+            wait_for(lambda: not t.is_alive(), t.join)
+        results = [results[i] for i in xrange(1, n + 1)]
+        failed = sum(1 for r in results if not r.ok)
+        l.info('%s %d cases, %d failed' % ('Would edit' if self.dry_run
+                                           else 'Edited', n - failed, failed))
+        return results
+
+    def _work(self, tasks, results):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            n, bug_id, changes = task
+            results[n] = self.edit(bug_id, changes)
+            with self._lock:
+                self.done += 1
+                if self.done % 100 == 0:
+                    l.info('%d edits done' % self.done)
+
+    def edit(self, bug_id, changes):
+        args = {}
+        for k, v in changes.iteritems():
+            if isinstance(v, (list, tuple)):
+                v = u','.join(v)
+            if isinstance(v, unicode):
+                v = v.encode('utf8')
+            args[k] = v
+        if self.dry_run:
+            l.info('Would edit case %d: %r' % (bug_id, args))
+            return EditResult(bug_id, changes, True, None, 0)
+        attempt = 0
+        while True:
+            try:
+                self.api.call('edit', ixBug=bug_id, **args)
+            except TransientError, e:
+                if attempt < self.retries:
+                    delay = self.api.backoff.delay(attempt)
+                    l.warning('Editing case %d failed, retrying in %.2fs: '
+                              '%s' % (bug_id, delay, e.msg))
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                error = e
+            except Exception, e:
+                error = e
+            else:
+                return EditResult(bug_id, changes, True, None, attempt + 1)
+            l.error('Editing case %d failed: %s' % (bug_id, error))
+            return EditResult(bug_id, changes, False, unicode(error),
+                              attempt + 1)
+
+def _text(elem, objects):
+    return elem.text
+
+def _int(elem, objects):
+    return int(elem.text) if elem.text else None
+
+def _float(elem, objects):
+    return float(elem.text) if elem.text else None
+
+def _tags(elem, objects):
+    return [t.text for t in elem.iterfind('tag')]
 
-    pass
+def _person(elem, objects):
+    # nobody is 0
+    id = int(elem.text) if elem.text else 0
+    return objects.get(Person, id) if id else None
+
+class Field(object):
+    """An attribute of an FBApiObject, loaded from a FogBugz column on first
+    access"""
+    def __init__(self, col, parse=_text):
+        self.col, self.parse = col, parse
+        self.name = self.slot = None
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            pass
+        obj._objects.load(cls, self.name, obj)
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            raise AttributeError('%s %d not found' % (cls.__name__, obj.id))
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+class FBApiObjectType(type):
+    """Gives each Field a slot, and makes Bug[123] work"""
+    def __new__(mcs, name, bases, attrs):
+        fields = {}
+        for base in bases:
+            fields.update(getattr(base, '_fields', {}))
+        slots = list(attrs.get('__slots__', ()))
+        for k, v in attrs.items():
+            if isinstance(v, Field):
+                v.name, v.slot = k, '_' + k
+                fields[k] = v
+                slots.append(v.slot)
+        attrs['__slots__'] = tuple(slots)
+        attrs['_fields'] = fields
+        return type.__new__(mcs, name, bases, attrs)
+
+    def __getitem__(cls, id):
+        return cls.get(id)
+
+class FBApiObject(object):
+    """Base object for retrieving and saving stuff through the API
+
+    Objects are unique per API session and id, and their fields are only
+    fetched when first read, along with the same fields of every other
+    object of the class in the session that doesn't have them yet.
+    """
+    __metaclass__ = FBApiObjectType
+    __slots__ = ('id', '_objects')
+    # whether _fetch only gets the ids it's given, so they can be batched
+    batched = True
+
+    def __repr__(self):
+        return '<%s %d>' % (self.__class__.__name__, self.id)
+
+    @classmethod
+    def get(cls, id, api=None):
+        """The object for id, without fetching anything yet"""
+        return (api or default_api()).objects.get(cls, id)
+
+    @classmethod
+    def _fetch(cls, objects, ids, cols):
+        """Yields the elements for ids, with the given columns"""
+        raise NotImplementedError
+
+    def _update(self, elem, names=None):
+        """Set fields, all of them or the ones in names, from elem"""
+        for name, field in self._fields.iteritems():
+            if names is not None and name not in names:
+                continue
+            col = elem.find(field.col)
+            setattr(self, field.slot,
+                    None if col is None else field.parse(col, self._objects))
 
 class Bug(FBApiObject):
-    pass
+    __slots__ = ()
+    id_col = 'ixBug'
+
+    title = Field('sTitle')
+    project = Field('sProject')
+    area = Field('sArea')
+    status = Field('sStatus')
+    tags = Field('tags', _tags)
+    opened = Field('dtOpened')
+    resolved = Field('dtResolved')
+    updated = Field('dtLastUpdated')
+    assigned_to = Field('ixPersonAssignedTo', _person)
+    resolved_by = Field('ixPersonResolvedBy', _person)
+    hours_elapsed_extra = Field('hrsElapsedExtra', _float)
+
+    @classmethod
+    def search(cls, q, fields=(), api=None, page_size=1000):
+        """Yield the Bugs matching q, with fields already loaded"""
+        api = api or default_api()
+        cols = [cls._fields[name].col for name in fields]
+        for case in api.search(q, cols=','.join(cols or ['ixBug']),
+                               page_size=page_size, prefetch=True):
+            bug = api.objects.get(cls, int(case.find('ixBug').text))
+            bug._update(case, fields)
+            yield bug
+
+    @classmethod
+    def _fetch(cls, objects, ids, cols):
+        # mostly consecutive ids are fetched as a range, others in lists
+        # short enough to keep URLs reasonable
+        cols = ','.join(['ixBug'] + cols)
+        if ids[-1] - ids[0] < 2 * len(ids):
+            queries = ['ixBug:"%d..%d"' % (ids[0], ids[-1])]
+        else:
+            queries = [' or '.join('ixBug:%d' % id for id in ids[n:n + 100])
+                       for n in xrange(0, len(ids), 100)]
+        for q in queries:
+            for case in objects.api.iter_call('search', tag='case', q=q,
+                                              cols=cols):
+                yield case
 
 class Person(FBApiObject):
-    pass
+    __slots__ = ()
+    id_col = 'ixPerson'
+    batched = False
+
+    name = Field('sFullName')
+    email = Field('sEmail')
+    phone = Field('sPhone')
+    admin = Field('fAdministrator', lambda e, o: e.text == 'true')
+
+    @classmethod
+    def _fetch(cls, objects, ids, cols):
+        # there's no searching people, get them all
+        resp = objects.api.call('listPeople', fIncludeNormal=1,
+                                fIncludeVirtual=1)
+        return resp.find('people').iterfind('person')
+
+class IdentityMap(object):
+    """The FBApiObjects of an API session, one per class and id
+
+    Loading a field loads it, along with any other field of the class read
+    so far, for every object of the class missing it, batch_size ids per
+    request. Ids FogBugz doesn't have aren't asked for again.
+    """
+    def __init__(self, api, batch_size=1000):
+        self.api = api
+        self.batch_size = batch_size
+        self._objects = {}
+        self._missing = set()
+        self._wanted = defaultdict(set)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._objects)
+
+    def get(self, cls, id):
+        with self._lock:
+            try:
+                return self._objects[cls, id]
+            except KeyError:
+                obj = self._objects[cls, id] = cls.__new__(cls)
+                obj.id, obj._objects = id, self
+                return obj
+
+    def load(self, cls, name, obj):
+        """Load field name of obj, and of all the other objects of cls
+        missing it"""
+        with self._lock:
+            if hasattr(obj, cls._fields[name].slot):
+                # another thread loaded it meanwhile
+                return
+            if (cls, obj.id) in self._missing:
+                return
+            self._wanted[cls].add(name)
+            names = set(self._wanted[cls])
+            slot = cls._fields[name].slot
+            pending = sorted(id for (c, id), o in self._objects.iteritems()
+                             if c is cls and not hasattr(o, slot)
+                             and (c, id) not in self._missing)
+            cols = [cls._fields[n].col for n in sorted(names)]
+            l.debug('Loading %s for %d %s objects'
+                    % (', '.join(sorted(names)), len(pending), cls.__name__))
+            batch_size = self.batch_size if cls.batched else len(pending)
+            for n in xrange(0, len(pending), batch_size):
+                ids = pending[n:n + batch_size]
+                for elem in cls._fetch(self, ids, cols):
+                    self.get(cls, int(elem.find(cls.id_col).text)
+                             )._update(elem, names)
+            for id in pending:
+                if not hasattr(self._objects[cls, id], slot):
+                    self._missing.add((cls, id))
+
+_default_api = None
 
-def login(base_url, username, password):
-    """Login to API globally"""
-    threading.local().fbapi = FogBugzAPI(base_url, username, password)
+def default_api():
+    """The API logged in with login(), shared by all threads"""
+    if _default_api is None:
+        raise NotLoggedOnError("call fogpy.fogbugzapi.login() first")
+    return _default_api
 
+def login(base_url, username, password, api_class=FogBugzAPI, **kwargs):
+    """Login to API globally, for Bug[123] and the like, in every thread"""
+    global _default_api
+    _default_api = api_class(base_url, username, password, **kwargs)
+    return _default_api
@@ -0,0 +1,136 @@
+"""Per-command API metrics and report stage timings
+
+FogBugzAPI records every call in a CallMetrics: count, latency histogram,
+bytes, parse time, retries and re-logons per command. Functions added with
+CallMetrics.add_hook are called with a dict describing each event, to
+forward them to some other telemetry system.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+l = logging.getLogger(__name__)
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (.01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30.)
+
+class CommandStats(object):
+    def __init__(self):
+        self.count = self.errors = self.cached = self.relogons = 0
+        self.retries = 0
+        self.bytes = self.wire_bytes = 0
+        self.latency = self.parse_time = 0.
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add_latency(self, seconds):
+        self.latency += seconds
+        for n, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.histogram[n] += 1
+                return
+        self.histogram[-1] += 1
+
+    def percentile(self, p):
+        """Upper bound of the histogram bucket the p-th percentile is in"""
+        target = p / 100. * sum(self.histogram)
+        seen = 0
+        for n, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= target:
+                return (LATENCY_BUCKETS[n] if n < len(LATENCY_BUCKETS)
+                        else float('inf'))
+        return 0.
+
+class CallMetrics(object):
+    def __init__(self):
+        self.commands = {}
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """hook(event) is called with a dict for every call, retry and
+        re-logon"""
+        self.hooks.append(hook)
+
+    def _stats(self, cmd):
+        try:
+            return self.commands[cmd]
+        except KeyError:
+            return self.commands.setdefault(cmd, CommandStats())
+
+    def record_call(self, cmd, latency, nbytes=0, wire_bytes=0,
+                    parse_time=0., error=None, cached=False):
+        with self._lock:
+            stats = self._stats(cmd)
+            stats.count += 1
+            stats.bytes += nbytes
+            stats.wire_bytes += wire_bytes
+            stats.parse_time += parse_time
+            if cached:
+                stats.cached += 1
+            else:
+                stats.add_latency(latency)
+            if error is not None:
+                stats.errors += 1
+        self._emit({'type': 'call', 'cmd': cmd, 'latency': latency,
+                    'bytes': nbytes, 'wire_bytes': wire_bytes,
+                    'parse_time': parse_time, 'cached': cached,
+                    'error': error})
+
+    def record_relogon(self, cmd):
+        with self._lock:
+            self._stats(cmd).relogons += 1
+        self._emit({'type': 'relogon', 'cmd': cmd})
+
+    def record_retry(self, cmd):
+        with self._lock:
+            self._stats(cmd).retries += 1
+        self._emit({'type': 'retry', 'cmd': cmd})
+
+    def _emit(self, event):
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception:
+                l.exception('metrics hook %r failed' % hook)
+
+    def report(self):
+        """Returns a table of the metrics, one line per command"""
+        lines = ['%-16s %6s %6s %6s %9s %9s %9s %12s %12s %8s' % (
+            'command', 'calls', 'cached', 'errors', 'latency', 'p50', 'p95',
+            'bytes', 'wire bytes', 'parse')]
+        with self._lock:
+            for cmd, s in sorted(self.commands.iteritems()):
+                lines.append(
+                    '%-16s %6d %6d %6d %8.3fs %8.3fs %8.3fs %12d %12d %7.3fs'
+                    % (cmd, s.count, s.cached, s.errors, s.latency,
+                       s.percentile(50), s.percentile(95), s.bytes,
+                       s.wire_bytes, s.parse_time)
+                    + (' (%d retries)' % s.retries if s.retries else '')
+                    + (' (%d re-logons)' % s.relogons if s.relogons else ''))
+        return '\n'.join(lines)
+
+class StageProfiler(object):
+    """Accumulates wall time spent in named stages"""
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.time() - t
+
+    def report(self):
+        total = sum(self.stages.itervalues())
+        lines = ['%-16s %9s %6s' % ('stage', 'time', '%')]
+        for name, seconds in self.stages.iteritems():
+            lines.append('%-16s %8.3fs %5.1f%%'
+                         % (name, seconds, 100 * seconds / (total or 1)))
+        lines.append('%-16s %8.3fs' % ('total', total))
+        return '\n'.join(lines)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+r"""Time reports over several FogBugz instances at once
+
+Usage: %prog [options] instances.ini start end
+
+example:
+    %prog -o /tmp/all.xls -x instances.ini \
+            2011-10-29T00:00:00Z 2011-11-30T00:00:00Z
+
+instances.ini has one section per FogBugz instance, its name being the
+instance's name in the report:
+
+    [consulting]
+    base_url = https://consulting.fogbugz.com/api.asp
+    username = foo@bar.com
+    password = mypassword
+
+Each instance's report runs in its own process, all at the same time, and
+their results are merged into one report with an instance column. An
+instance that fails, or takes longer than --timeout, is listed as such in
+the report, after the others.
+"""
+
+from collections import defaultdict, namedtuple
+import ConfigParser
+import csv
+import iso8601
+import logging
+import multiprocessing
+from optparse import OptionParser
+import sys
+import time
+
+from fogpy.spreadsheet import XlsWorkbook, XlsxWorkbook
+from fogpy.waiting import wait_for
+from fogpy.timereport import TimeReporting, fixed_tags
+
+l = logging.getLogger(__name__)
+
+Instance = namedtuple('Instance', ('name', 'base_url', 'username',
+                                   'password'))
+
+def read_instances(path):
+    """Instances from an ini file, one section per instance"""
+    config = ConfigParser.RawConfigParser()
+    if not config.read(path):
+        raise IOError("Can't read %s" % path)
+    if not config.sections():
+        raise ValueError("%s: no instances" % path)
+    try:
+        return [Instance(name, config.get(name, 'base_url'),
+                         config.get(name, 'username'),
+                         config.get(name, 'password'))
+                for name in config.sections()]
+    except ConfigParser.NoOptionError, e:
+        raise ValueError("%s: %s" % (path, e))
+
+class InstanceReport(object):
+    """What a report on one instance sends back from its process"""
+    def __init__(self, instance, hours_perdev=None, all_tags=(),
+                 bad_num_tags=(), bad_tags_filter=None, details=None,
+                 seconds=None, error=None):
+        self.instance = instance
+        self.hours_perdev = hours_perdev or {}
+        self.all_tags = set(all_tags)
+        self.bad_num_tags = sorted(bad_num_tags)
+        self.bad_tags_filter = bad_tags_filter
+        self.details = details
+        self.seconds = seconds
+        self.error = error
+
+    @property
+    def status(self):
+        if self.error is not None:
+            return u'failed: %s' % self.error
+        return u'ok in %.1fs' % self.seconds
+
+def report_instance(instance, start, end, details=False, report_kwargs={}):
+    """Run the report on one instance, catching any error"""
+    t = time.time()
+    try:
+        tr = TimeReporting(instance.username, instance.password,
+                           instance.base_url, start, end, **report_kwargs)
+        try:
+            rows = None
+            if details:
+                rows = [tuple(e) for e in tr.get_hours_details()]
+            hours = tr.get_all_hours_per_tag_per_dev()
+        finally:
+            tr.logout()
+    except Exception, e:
+        l.exception('Report on %s failed' % instance.name)
+        return InstanceReport(instance, seconds=time.time() - t,
+                              error=u'%s: %s' % (type(e).__name__, e))
+    return InstanceReport(
+        instance, dict((dev, dict(tags)) for dev, tags in hours.iteritems()),
+        tr.all_tags, tr.bad_num_tags,
+        tr.fb_filter_for_bugs(tr.bad_num_tags) if tr.bad_num_tags else None,
+        rows, time.time() - t)
+
+def _report_instance(args):
+    # Pool.imap only passes one argument
+    return report_instance(*args)
+
+def run_reports(instances, start, end, details=False, processes=None,
+                timeout=None, **report_kwargs):
+    """Run the report on every instance in parallel, in a process pool
+
+    Takes about as long as the slowest instance, with the default of one
+    process per instance. Instances that haven't finished timeout seconds
+    after the start are given up on. Returns a MultiReport.
+    """
+    pool = multiprocessing.Pool(processes or len(instances),
+                                maxtasksperchild=1)
+    results = [pool.apply_async(_report_instance,
+                                ((i, start, end, details, report_kwargs), ))
+               for i in instances]
+    pool.close()
+    deadline = None if timeout is None else time.time() + timeout
+    reports = []
+    timed_out = False
+    for instance, result in zip(instances, results):
+        if wait_for(result.ready, result.wait,
+                    None if deadline is None
+                    else max(0, deadline - time.time())):
+            reports.append(result.get())
+        else:
+            l.error('Report on %s timed out' % instance.name)
+            reports.append(InstanceReport(
+                instance, error=u'timed out after %ss' % timeout))
+            timed_out = True
+    if timed_out:
+        pool.terminate()
+    pool.join()
+    return MultiReport(start, end, reports)
+
+class MultiReport(object):
+    """Reports on several instances, merged with an instance dimension
+
+    Hours are per instance and dev, plus per dev over all instances; the
+    details are every instance's, with the instance's name in front.
+    """
+    def __init__(self, start_date, end_date, reports):
+        self.start_date, self.end_date = start_date, end_date
+        self.reports = reports
+        self.all_tags = set()
+        for r in reports:
+            self.all_tags.update(r.all_tags)
+        self.hours = defaultdict(lambda: defaultdict(int))
+        for r in reports:
+            for dev, tags in r.hours_perdev.iteritems():
+                for t, hours in tags.iteritems():
+                    self.hours[r.instance.name, dev][t] += hours
+                    self.hours[u'all', dev][t] += hours
+
+    @property
+    def failed(self):
+        return [r for r in self.reports if r.error is not None]
+
+    def _summary_rows(self):
+        tags = fixed_tags(self.all_tags)
+        yield [u'instance', u'dev name'] + tags, True
+        names = [r.instance.name for r in self.reports] + [u'all']
+        for name in names:
+            for (instance, dev), v in sorted(self.hours.iteritems()):
+                if instance == name:
+                    yield [instance, dev] + [v[t] for t in tags], False
+
+        yield [], False
+        yield [u"Hours for %s-%s" % (self.start_date, self.end_date)], False
+        for r in self.reports:
+            yield [], False
+            yield [r.instance.name, r.status], False
+            if r.bad_num_tags:
+                yield [u"Bugs with len(tags) != 1:",
+                       ' '.join(`b` for b in r.bad_num_tags)], False
+                yield [u"Bad tags fb filter: ", r.bad_tags_filter], False
+
+    def _details_rows(self):
+        yield [u"instance", u"date", u"time", u"bug_num", u"title",
+               u"dev_name", u"hours", u"project", u"tag", u"url",
+               u"type"], True
+        for r in self.reports:
+            for entry in r.details or ():
+                # split date and time, which lets you pivot to sum by day
+                yield ([r.instance.name] + entry[0].split('T')
+                       + list(entry[1:])), False
+
+    def write_csv(self, f, details=False):
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        rows = self._details_rows() if details else self._summary_rows()
+        for cells, bold in rows:
+            writer.writerow([c.encode('utf8') if isinstance(c, unicode)
+                             else c for c in cells])
+
+    def add_sheets(self, wb, details=False):
+        ws = wb.add_sheet(u'Summary')
+        for cells, bold in self._summary_rows():
+            ws.write_row(cells, bold)
+        if details:
+            ws = wb.add_sheet(u'Hours details')
+            for cells, bold in self._details_rows():
+                ws.write_row(cells, bold)
+
+    def write_xls_report(self, file_out, details=False,
+                         workbook_class=XlsWorkbook):
+        wb = workbook_class(file_out)
+        self.add_sheets(wb, details)
+        wb.close()
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("-o", "--output", dest="outfile", metavar="FILE",
+                      default="/tmp/fb-all-#s-#e.#x",
+                      help="Output file name [%default]. "
+                           "#s, #e, #x will insert start and end datetimes, "
+                           "and file extension, respectively. Use - to "
+                           "output to stdout.")
+    parser.add_option("-l", "--long", dest="long", default=False,
+                      action='store_true',
+                      help="Output details for each instance, rather than "
+                           "the summary.")
+    parser.add_option("-x", "--xls", dest="xls", default=False,
+                      action='store_true',
+                      help="Output xls file with summary sheet. And details "
+                           "sheet if -l/--long is provided.")
+    parser.add_option("--xlsx", dest="xlsx", default=False,
+                      action='store_true',
+                      help="Like -x/--xls, but output an xlsx file.")
+    parser.add_option("--processes", dest="processes", default=None,
+                      type='int',
+                      help="Instances to report on at once [one process "
+                           "per instance]")
+    parser.add_option("--timeout", dest="timeout", default=None,
+                      type='float', metavar="SECONDS",
+                      help="Give up on instances not done after that long.")
+    parser.add_option("--cache-dir", dest="cache_dir", metavar="DIR",
+                      default=None,
+                      help="Keep each instance's bugs and people in a local "
+                           "database in DIR.")
+    parser.add_option("--workers", dest="max_workers", default=4,
+                      type='int',
+                      help="Maximum concurrent API requests per instance "
+                           "[%default]")
+    (options, args) = parser.parse_args()
+
+    if len(args) < 3:
+        l.error("You need to provide the instances file, and start and end "
+                "date, in iso8601 format")
+        parser.print_help()
+        sys.exit(1)
+    try:
+        instances = read_instances(args[0])
+    except (IOError, ValueError, ConfigParser.Error), e:
+        l.error(str(e))
+        sys.exit(1)
+    start_date = iso8601.parse_date(args[1])
+    end_date = iso8601.parse_date(args[2])
+
+    if options.xlsx:
+        extension = 'xlsx'
+    elif options.xls:
+        extension = 'xls'
+    else:
+        extension = 'csv'
+    filename = options.outfile.replace('#s', args[1]).replace(
+        '#e', args[2]).replace('#x', extension)
+
+    report = run_reports(instances, start_date, end_date,
+                         details=options.long, processes=options.processes,
+                         timeout=options.timeout, cache_dir=options.cache_dir,
+                         max_workers=options.max_workers)
+    f = sys.stdout if filename == '-' else open(filename, 'wb')
+    if options.xls or options.xlsx:
+        report.write_xls_report(f, details=options.long,
+                                workbook_class=XlsxWorkbook if options.xlsx
+                                               else XlsWorkbook)
+    else:
+        report.write_csv(f, details=options.long)
+    if f is not sys.stdout:
+        f.close()
+    for r in report.reports:
+        l.info('%s: %s' % (r.instance.name, r.status))
+    if report.failed:
+        sys.exit(2)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+r"""Serve time reports over HTTP from a long-running FogBugz session
+
+Usage: %prog [options]
+
+example:
+    %prog -u foo@bar.com -p mypassword \
+            -b https://ecometrica.fogbugz.com/api.asp --port 8080
+    curl 'http://localhost:8080/report?period=week&format=json'
+
+The server logs on once, and keeps the people and the cases it has seen
+in memory, refreshing them every --refresh seconds in the background, so
+that a report only needs its period's intervals and resolved cases.
+Reports are kept for --result-ttl seconds, and identical requests coming
+in while one is being computed wait for it rather than compute it again.
+
+GET /report takes:
+    start, end      iso8601 datetimes; or
+    period          day, week, month, quarter or year: the current one
+    format          csv (default), xls, xlsx or json
+    details         1 for the hours details instead of the summary
+
+GET /status returns cache and API call counts as JSON.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+from cStringIO import StringIO
+import datetime as dt
+import iso8601
+import json
+import logging
+from optparse import OptionParser
+import os
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+from fogpy.timereport import (BATCH_PERIODS, TimeReporting, next_period,
+                              period_start, settings)
+from fogpy.waiting import wait_for
+
+l = logging.getLogger(__name__)
+
+FORMATS = {
+    'csv': 'text/tab-separated-values; charset=utf-8',
+    'xls': 'application/vnd.ms-excel',
+    'xlsx': ('application/vnd.openxmlformats-officedocument.'
+             'spreadsheetml.sheet'),
+    'json': 'application/json',
+}
+
+class BadRequest(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    def __unicode__(self):
+        return self.msg
+
+class _Flight(object):
+    """A value being computed, for the callers waiting on it"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = self.error = None
+
+class MemoCache(object):
+    """Computed values, the max_entries last used ones, for ttl seconds
+
+    get(key, compute) returns the value for key, calling compute() if it
+    isn't cached. Callers asking for a key that's already being computed
+    wait for that computation and get its value, or its exception. Errors
+    aren't cached.
+    """
+    def __init__(self, max_entries=100, ttl=60.):
+        self.max_entries, self.ttl = max_entries, ttl
+        self.hits = self.misses = self.coalesced = 0
+        self._data = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._data:
+                value, expires = self._data.pop(key)
+                if expires > time.time():
+                    self._data[key] = value, expires
+                    self.hits += 1
+                    return value
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if leader:
+            try:
+                flight.value = compute()
+            except Exception, e:
+                flight.error = e
+            with self._lock:
+                del self._flights[key]
+                if flight.error is None:
+                    self._data[key] = flight.value, time.time() + self.ttl
+                    while len(self._data) > self.max_entries:
+                        self._data.popitem(last=False)
+            flight.done.set()
+        else:
+            wait_for(flight.done.is_set, flight.done.wait)
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class ReportService(object):
+    """Reports for any period, from one warm TimeReporting session
+
+    Each report is a view of the session's TimeReporting for its period,
+    sharing its API session, people and cases.
+    """
+    def __init__(self, tr, result_ttl=60., max_results=100, refresh=300.):
+        self.tr = tr
+        self.results = MemoCache(max_results, result_ttl)
+        self.refresh_interval = refresh
+        self.started = time.time()
+        self._refreshed = dt.datetime.utcnow()
+        self._stop = threading.Event()
+        self._refresher = None
+
+    def start_refresh(self):
+        if self.refresh_interval:
+            self._refresher = threading.Thread(target=self._refresh_loop,
+                                               name='fogpy refresh')
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                l.exception('Refreshing people and cases failed')
+
+    def refresh(self):
+        """Fetch people again, and the cases updated since last time"""
+        since, self._refreshed = self._refreshed, dt.datetime.utcnow()
+        self.tr.get_devinfo(0)
+        # edited: only has a day's precision
+        fetched = self.tr.get_buginfo('edited:"%s.."'
+                                      % since.strftime('%m/%d/%Y'))
+        l.info('Refreshed people and %d cases' % len(fetched))
+
+    def report(self, start, end, format='csv', details=False):
+        """Returns the report's body"""
+        if format not in FORMATS:
+            raise BadRequest('format should be one of %s'
+                             % ', '.join(sorted(FORMATS)))
+        if not start < end:
+            raise BadRequest('start should be before end')
+        return self.results.get(
+            (start, end, format, bool(details)),
+            lambda: self._render(start, end, format, details))
+
+    def _render(self, start, end, format, details):
+        report, = self.tr.get_period_reports([(start, end)])
+        f = StringIO()
+        if format == 'json':
+            json.dump(self._json(report, details), f)
+        elif format in ('xls', 'xlsx'):
+            write = (report.write_xlsx_report if format == 'xlsx'
+                     else report.write_xls_report)
+            write(f, details=details)
+        elif details:
+            report.write_csv_detailed(f)
+        else:
+            report.write_csv_cumulative(f)
+        return f.getvalue()
+
+    def _json(self, report, details):
+        result = {'start': report.start_date.isoformat() + 'Z',
+                  'end': report.end_date.isoformat() + 'Z',
+                  'bad_num_tags': sorted(report.bad_num_tags)}
+        if details:
+            result['details'] = [e._asdict()
+                                 for e in report.iter_hours_details()]
+        else:
+            result['hours'] = report.get_all_hours_per_tag_per_dev()
+        return result
+
+    def status(self):
+        return {
+            'uptime': time.time() - self.started,
+            'results': {'cached': len(self.results),
+                        'hits': self.results.hits,
+                        'misses': self.results.misses,
+                        'coalesced': self.results.coalesced},
+            'people': len(self.tr.devs),
+            'cases': len(self.tr.bugs),
+            'api_calls': dict((cmd, s.count) for cmd, s in
+                              self.tr.fbapi.metrics.commands.iteritems()),
+        }
+
+def parse_period(query, now=None):
+    """(start, end) from a /report query, as naive UTC datetimes"""
+    if 'period' in query:
+        period = BATCH_PERIODS.get(query['period'], query['period'])
+        if period not in BATCH_PERIODS.values():
+            raise BadRequest('period should be one of %s'
+                             % ', '.join(sorted(BATCH_PERIODS.values())))
+        start = period_start(now or dt.datetime.utcnow(), period)
+        return start, next_period(start, period)
+    try:
+        return tuple(_utc(iso8601.parse_date(query[k]))
+                     for k in ('start', 'end'))
+    except KeyError:
+        raise BadRequest('Either period, or start and end are needed')
+    except iso8601.ParseError, e:
+        raise BadRequest(str(e))
+
+def _utc(d):
+    if d.tzinfo is not None:
+        d = (d - d.utcoffset()).replace(tzinfo=None)
+    return d
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        service = self.server.service
+        try:
+            if url.path == '/report':
+                start, end = parse_period(query)
+                format = query.get('format', 'csv')
+                body = service.report(start, end, format,
+                                      query.get('details') in ('1', 'true'))
+                self._respond(200, FORMATS[format], body)
+            elif url.path == '/status':
+                self._respond(200, FORMATS['json'],
+                              json.dumps(service.status()))
+            else:
+                self._respond(404, 'text/plain', 'Not found\n')
+        except BadRequest, e:
+            self._respond(400, 'text/plain', e.msg + '\n')
+        except Exception, e:
+            l.exception('%s failed' % self.path)
+            self._respond(500, 'text/plain', '%s: %s\n'
+                          % (type(e).__name__, e))
+
+    def _respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # client_address is empty on Unix sockets
+        l.info(format % args)
+
+class ReportServer(SocketServer.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, ReportRequestHandler)
+        self.service = service
+
+class UnixReportServer(SocketServer.ThreadingMixIn,
+                       SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path,
+                                               ReportRequestHandler)
+        self.service = service
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        os.remove(self.server_address)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("-u", "--username", dest="username",
+                      help="FogBugz username",
+                      default=settings.get('username', ''))
+    parser.add_option("-p", "--password", dest="password",
+                      help="FogBugz password",
+                      default=settings.get('password', ''))
+    parser.add_option("-b", "--baseurl", dest="base_url",
+                      help="FogBugz API base URL",
+                      default=settings.get('base_url', ''))
+    parser.add_option("--host", dest="host", default='127.0.0.1',
+                      help="Address to listen on [%default]")
+    parser.add_option("--port", dest="port", default=8080, type='int',
+                      help="Port to listen on [%default]")
+    parser.add_option("--socket", dest="socket", metavar="PATH",
+                      default=None,
+                      help="Listen on a Unix socket at PATH instead.")
+    parser.add_option("-f", "--prefetch", dest="prefetch", default=False,
+                      action='store_true',
+                      help="Fetch all cases at startup.")
+    parser.add_option("--refresh", dest="refresh", default=300.,
+                      type='float', metavar="SECONDS",
+                      help="Fetch people and updated cases again every "
+                           "SECONDS [%default]; 0 never does.")
+    parser.add_option("--result-ttl", dest="result_ttl", default=60.,
+                      type='float', metavar="SECONDS",
+                      help="Serve a report computed less than SECONDS ago "
+                           "again, instead of computing it [%default]")
+    parser.add_option("--results", dest="max_results", default=100,
+                      type='int',
+                      help="Number of reports kept [%default]")
+    parser.add_option("--cache-dir", dest="cache_dir", metavar="DIR",
+                      default=settings.get('cache_dir'),
+                      help="Also keep cases and people in a local database "
+                           "in DIR, to start warm.")
+    parser.add_option("--shard-days", dest="shard_days", default=None,
+                      type='int',
+                      help="Fetch intervals this many days at a time, "
+                           "concurrently.")
+    parser.add_option("--workers", dest="max_workers", default=4,
+                      type='int',
+                      help="Maximum concurrent API requests [%default]")
+    (options, args) = parser.parse_args()
+
+    if not (options.username and options.password and options.base_url):
+        l.error("You need to provide a username, password and base url")
+        parser.print_help()
+        sys.exit(1)
+
+    tr = TimeReporting(options.username, options.password, options.base_url,
+                       prefetch=options.prefetch, cache_dir=options.cache_dir,
+                       shard_days=options.shard_days,
+                       max_workers=options.max_workers)
+    service = ReportService(tr, result_ttl=options.result_ttl,
+                            max_results=options.max_results,
+                            refresh=options.refresh)
+    if options.socket:
+        server = UnixReportServer(options.socket, service)
+    else:
+        server = ReportServer((options.host, options.port), service)
+    l.info('Serving reports on %s' % (options.socket or 'http://%s:%d/'
+                                      % server.server_address))
+    service.start_refresh()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
+        tr.logout()
@@ -0,0 +1,162 @@
+"""Cache of raw API responses, for FogBugzAPI
+
+Responses of read-only commands are keyed on the command and its
+arguments, without the token. They are kept in an in-memory LRU, and
+optionally in a directory on disk, with a TTL and a size limit. In replay
+mode, responses are only ever served from the cache, and a miss is an
+error instead of a request to FogBugz.
+"""
+
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+l = logging.getLogger(__name__)
+
+class ReplayMissError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    def __unicode__(self):
+        return self.msg
+
+def is_cacheable(cmd):
+    """Only commands that don't change anything are cached"""
+    return cmd == 'search' or cmd.startswith('list') or cmd.startswith('view')
+
+def cache_key(cmd, kwargs):
+    args = sorted((k, _unicode(v).encode('utf8'))
+                  for k, v in kwargs.iteritems() if k != 'token')
+    return hashlib.sha1(repr((cmd, args))).hexdigest()
+
+def _unicode(value):
+    # byte strings are utf8, as they are in the request
+    if isinstance(value, str):
+        return value.decode('utf8')
+    return unicode(value)
+
+class LRUCache(object):
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+class DiskCache(object):
+    """One file per response in directory
+
+    Files older than ttl seconds are ignored, and the oldest files are
+    removed once they take more than max_bytes altogether.
+    """
+    def __init__(self, directory, ttl=None, max_bytes=None):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.ttl, self.max_bytes = ttl, max_bytes
+        self._lock = threading.Lock()
+        self._size = sum(size for path, mtime, size in self._files())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.xml')
+
+    def _files(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith('.xml'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield path, st.st_mtime, st.st_size
+
+    def get(self, key, ignore_ttl=False):
+        path = self._path(key)
+        try:
+            if (self.ttl is not None and not ignore_ttl
+                    and time.time() - os.path.getmtime(path) > self.ttl):
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def put(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        path = self._path(key)
+        with self._lock:
+            if os.path.exists(path):
+                self._size -= os.path.getsize(path)
+            os.rename(tmp_path, path)
+            self._size += len(value)
+            if self.max_bytes is not None and self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        files = sorted(self._files(), key=lambda f: f[1])
+        self._size = sum(size for path, mtime, size in files)
+        for path, mtime, size in files:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+            l.debug('evicted %s from response cache' % path)
+
+class ResponseCache(object):
+    def __init__(self, max_entries=128, directory=None, ttl=None,
+                 max_bytes=None, replay=False):
+        if replay and directory is None:
+            raise ValueError("replay mode needs a cache directory")
+        self.memory = LRUCache(max_entries)
+        self.disk = None
+        if directory is not None:
+            self.disk = DiskCache(directory, ttl=ttl, max_bytes=max_bytes)
+        self.replay = replay
+        self.hits = self.misses = 0
+
+    def get(self, cmd, kwargs):
+        """Returns the cached response body, or None"""
+        key = cache_key(cmd, kwargs)
+        body = self.memory.get(key)
+        if body is None and self.disk is not None:
+            # in replay mode whatever was recorded is what we want
+            body = self.disk.get(key, ignore_ttl=self.replay)
+            if body is not None:
+                self.memory.put(key, body)
+        if body is None:
+            self.misses += 1
+            if self.replay:
+                raise ReplayMissError("no recorded response for %s %r"
+                                      % (cmd, sorted(kwargs.items())))
+        else:
+            self.hits += 1
+        return body
+
+    def put(self, cmd, kwargs, body):
+        key = cache_key(cmd, kwargs)
+        self.memory.put(key, body)
+        if self.disk is not None:
+            self.disk.put(key, body)
@@ -0,0 +1,273 @@
+"""Spreadsheet writers for reports of any size
+
+Rows are written one at a time and don't stay in memory: XlsWorkbook has
+xlwt flush them to a temporary file every FLUSH_ROWS rows, XlsxWorkbook
+writes each sheet's XML to a temporary file as it goes, and only zips the
+whole workbook up when it's closed. A sheet that reaches the format's row
+limit is continued on a new sheet, "Name (2)" and so on, starting with
+the same header row. Sheet names are made unique, as Excel requires, by
+adding " (2)" and so on to names already used.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+from xml.sax.saxutils import escape, quoteattr
+import zipfile
+
+import xlwt
+
+FLUSH_ROWS = 1000
+
+class Sheet(object):
+    """A sheet being written, row after row"""
+    def __init__(self, workbook, name):
+        self.workbook, self.name = workbook, name
+        self.header = None
+        self.part = 1
+        self.rows = 0
+        self._sheet = workbook._new_sheet(name)
+
+    def write_row(self, cells, bold=False):
+        """Write cells, skipping None ones; pass [] for an empty row"""
+        if self.rows == self.workbook.max_rows:
+            self.part += 1
+            self._sheet = self.workbook._new_sheet(
+                u'%s (%d)' % (self.name[:25], self.part))
+            self.rows = 0
+            if self.header is not None:
+                self._sheet.write(0, self.header, True)
+                self.rows = 1
+        elif bold and self.rows == 0:
+            self.header = cells
+        self._sheet.write(self.rows, cells, bold)
+        self.rows += 1
+
+class Workbook(object):
+    """What XlsWorkbook and XlsxWorkbook have in common"""
+    def __init__(self):
+        self._sheet_names = set()
+
+    def add_sheet(self, name):
+        return Sheet(self, name)
+
+    def _new_sheet(self, name):
+        # names are at most 31 characters, unique regardless of case
+        name = _sheet_name(name)
+        unique, n = name, 1
+        while unique.lower() in self._sheet_names:
+            n += 1
+            suffix = u' (%d)' % n
+            unique = name[:31 - len(suffix)] + suffix
+        self._sheet_names.add(unique.lower())
+        return self._add_sheet(unique)
+
+class XlsWorkbook(Workbook):
+    """Excel 97 workbook, 65536 rows per sheet"""
+    max_rows = 65536
+
+    def __init__(self, file_out):
+        super(XlsWorkbook, self).__init__()
+        self.file_out = file_out
+        self._wb = xlwt.Workbook(encoding='utf8')
+        self._bold = xlwt.XFStyle()
+        self._bold.font = xlwt.Font()
+        self._bold.font.bold = True
+
+    def _add_sheet(self, name):
+        return _XlsSheet(self._wb.add_sheet(name), self._bold)
+
+    def close(self):
+        self._wb.save(self.file_out)
+
+class _XlsSheet(object):
+    def __init__(self, ws, bold_style):
+        self.ws, self.bold_style = ws, bold_style
+
+    def write(self, rowx, cells, bold):
+        row = self.ws.row(rowx)
+        for colx, cell in enumerate(cells):
+            if cell is None:
+                continue
+            if bold:
+                row.write(colx, cell, self.bold_style)
+            else:
+                row.write(colx, cell)
+        if rowx % FLUSH_ROWS == FLUSH_ROWS - 1:
+            self.ws.flush_row_data()
+
+class XlsxWorkbook(Workbook):
+    """Office Open XML workbook, 1048576 rows per sheet
+
+    Strings are written inline rather than in a shared strings table, so
+    that nothing grows with the number of rows.
+    """
+    max_rows = 1048576
+
+    def __init__(self, file_out, tmp_dir=None):
+        super(XlsxWorkbook, self).__init__()
+        self.file_out = file_out
+        self.tmp_dir = tmp_dir
+        self._sheets = []
+
+    def _add_sheet(self, name):
+        sheet = _XlsxSheet(name, self.tmp_dir)
+        self._sheets.append(sheet)
+        return sheet
+
+    def close(self):
+        out = self.file_out
+        try:
+            if not isinstance(out, basestring):
+                out.tell()
+        except (AttributeError, IOError):
+            # zipfile needs to seek, e.g. not on stdout
+            out = tempfile.TemporaryFile(dir=self.tmp_dir)
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('[Content_Types].xml', self._content_types())
+            z.writestr('_rels/.rels', _ROOT_RELS)
+            z.writestr('xl/workbook.xml', self._workbook())
+            z.writestr('xl/_rels/workbook.xml.rels', self._workbook_rels())
+            z.writestr('xl/styles.xml', _STYLES)
+            for n, sheet in enumerate(self._sheets):
+                sheet.close()
+                z.write(sheet.path, 'xl/worksheets/sheet%d.xml' % (n + 1))
+                os.remove(sheet.path)
+        if out is not self.file_out:
+            out.seek(0)
+            shutil.copyfileobj(out, self.file_out)
+            out.close()
+
+    def _content_types(self):
+        return (_XML_DECL
+                + '<Types xmlns="http://schemas.openxmlformats.org/package'
+                  '/2006/content-types">'
+                  '<Default Extension="rels" ContentType="application/'
+                  'vnd.openxmlformats-package.relationships+xml"/>'
+                  '<Default Extension="xml" ContentType="application/xml"/>'
+                  '<Override PartName="/xl/workbook.xml" ContentType="'
+                  'application/vnd.openxmlformats-officedocument.'
+                  'spreadsheetml.sheet.main+xml"/>'
+                  '<Override PartName="/xl/styles.xml" ContentType="'
+                  'application/vnd.openxmlformats-officedocument.'
+                  'spreadsheetml.styles+xml"/>'
+                + ''.join('<Override PartName="/xl/worksheets/sheet%d.xml" '
+                          'ContentType="application/vnd.openxmlformats-'
+                          'officedocument.spreadsheetml.worksheet+xml"/>'
+                          % (n + 1) for n in xrange(len(self._sheets)))
+                + '</Types>')
+
+    def _workbook(self):
+        sheets = ''.join(
+            '<sheet name=%s sheetId="%d" r:id="rId%d"/>'
+            % (quoteattr(sheet.name).encode('utf8'), n + 1,
+               n + 1)
+            for n, sheet in enumerate(self._sheets))
+        return (_XML_DECL
+                + '<workbook xmlns="http://schemas.openxmlformats.org/'
+                  'spreadsheetml/2006/main" xmlns:r="http://schemas.'
+                  'openxmlformats.org/officeDocument/2006/relationships">'
+                  '<sheets>' + sheets + '</sheets></workbook>')
+
+    def _workbook_rels(self):
+        rels = ['<Relationship Id="rId%d" Type="http://schemas.'
+                'openxmlformats.org/officeDocument/2006/relationships/'
+                'worksheet" Target="worksheets/sheet%d.xml"/>' % (n + 1, n + 1)
+                for n in xrange(len(self._sheets))]
+        rels.append('<Relationship Id="rId%d" Type="http://schemas.'
+                    'openxmlformats.org/officeDocument/2006/relationships/'
+                    'styles" Target="styles.xml"/>'
+                    % (len(self._sheets) + 1))
+        return (_XML_DECL
+                + '<Relationships xmlns="http://schemas.openxmlformats.org/'
+                  'package/2006/relationships">' + ''.join(rels)
+                + '</Relationships>')
+
+class _XlsxSheet(object):
+    def __init__(self, name, tmp_dir):
+        self.name = name
+        fd, self.path = tempfile.mkstemp(suffix='.xml', dir=tmp_dir)
+        self.f = os.fdopen(fd, 'wb')
+        self.f.write(_XML_DECL
+                     + '<worksheet xmlns="http://schemas.openxmlformats.org/'
+                       'spreadsheetml/2006/main"><sheetData>')
+
+    def write(self, rowx, cells, bold):
+        if not cells:
+            return
+        style = ' s="1"' if bold else ''
+        parts = ['<row r="%d">' % (rowx + 1)]
+        for colx, cell in enumerate(cells):
+            if cell is None:
+                continue
+            ref = '%s%d' % (_column(colx), rowx + 1)
+            if isinstance(cell, bool):
+                parts.append('<c r="%s" t="b"%s><v>%d</v></c>'
+                             % (ref, style, cell))
+            elif isinstance(cell, (int, long, float)):
+                parts.append('<c r="%s"%s><v>%r</v></c>' % (ref, style, cell))
+            else:
+                parts.append('<c r="%s" t="inlineStr"%s><is>%s</is></c>'
+                             % (ref, style, _text(cell)))
+        parts.append('</row>')
+        self.f.write(''.join(parts))
+
+    def close(self):
+        self.f.write('</sheetData></worksheet>')
+        self.f.close()
+
+_XML_DECL = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+_ROOT_RELS = (_XML_DECL
+              + '<Relationships xmlns="http://schemas.openxmlformats.org/'
+                'package/2006/relationships"><Relationship Id="rId1" '
+                'Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+                'relationships/officeDocument" Target="xl/workbook.xml"/>'
+                '</Relationships>')
+
+# style 0 is the default, style 1 is bold
+_STYLES = (_XML_DECL
+           + '<styleSheet xmlns="http://schemas.openxmlformats.org/'
+             'spreadsheetml/2006/main">'
+             '<fonts count="2"><font><sz val="11"/><name val="Calibri"/>'
+             '</font><font><b/><sz val="11"/><name val="Calibri"/></font>'
+             '</fonts><fills count="2"><fill><patternFill patternType="none"'
+             '/></fill><fill><patternFill patternType="gray125"/></fill>'
+             '</fills><borders count="1"><border><left/><right/><top/>'
+             '<bottom/><diagonal/></border></borders><cellStyleXfs count="1">'
+             '<xf numFmtId="0" fontId="0" fillId="0" borderId="0"/>'
+             '</cellStyleXfs><cellXfs count="2"><xf numFmtId="0" fontId="0" '
+             'fillId="0" borderId="0" xfId="0"/><xf numFmtId="0" fontId="1" '
+             'fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+             '<cellStyles count="1"><cellStyle name="Normal" xfId="0" '
+             'builtinId="0"/></cellStyles></styleSheet>')
+
+# characters XML 1.0 doesn't allow
+_INVALID_XML = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+_columns = {}
+
+def _column(colx):
+    """0 -> A, 25 -> Z, 26 -> AA..."""
+    try:
+        return _columns[colx]
+    except KeyError:
+        name, n = '', colx + 1
+        while n:
+            n, r = divmod(n - 1, 26)
+            name = chr(ord('A') + r) + name
+        _columns[colx] = name
+        return name
+
+def _text(value):
+    if not isinstance(value, unicode):
+        value = str(value).decode('utf8')
+    value = escape(_INVALID_XML.sub(u'', value)).encode('utf8')
+    if value[:1].isspace() or value[-1:].isspace():
+        return '<t xml:space="preserve">%s</t>' % value
+    return '<t>%s</t>' % value
+
+def _sheet_name(name):
+    """name without the characters sheet names can't have, cut to 31"""
+    return re.sub(r'[\[\]:*?/\\]', '_', name)[:31]
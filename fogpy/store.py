@@ -0,0 +1,181 @@
+"""Local SQLite store for FogBugz data that rarely changes
+
+Keeps case and person records between runs, along with a sync watermark
+so that only cases updated since the last run need to be fetched again.
+Hours summed per period, dev, case and entry type are kept as rollups,
+with a fingerprint of the intervals and resolved cases they were computed
+from.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import urlparse
+
+l = logging.getLogger(__name__)
+
+SCHEMA = """
+create table if not exists cases (
+    ixBug integer primary key,
+    title text,
+    tags text,
+    project text,
+    resolved text,
+    updated text
+);
+create table if not exists people (
+    ixPerson integer primary key,
+    name text,
+    email text
+);
+create table if not exists rollup_periods (
+    period text primary key,
+    fingerprint text,
+    computed text
+);
+create table if not exists rollups (
+    period text,
+    ixPerson integer,
+    ixBug integer,
+    type integer,
+    hours real
+);
+create index if not exists rollups_period on rollups (period);
+create table if not exists meta (
+    key text primary key,
+    value text
+);
+"""
+
+def store_path(cache_dir, base_url):
+    """One database file per FogBugz instance"""
+    host = urlparse.urlsplit(base_url).netloc.replace(':', '_') or 'fogbugz'
+    return os.path.join(cache_dir, '%s.sqlite' % host)
+
+class LocalStore(object):
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    @classmethod
+    def for_instance(cls, cache_dir, base_url):
+        return cls(store_path(cache_dir, base_url))
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._db.execute('select value from meta where key = ?',
+                                   (key, )).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._db.execute('insert or replace into meta values (?, ?)',
+                             (key, value))
+            self._db.commit()
+
+    def load_cases(self):
+        """Returns {ixBug: bug info} in the format of TimeReporting.bugs"""
+        with self._lock:
+            rows = self._db.execute(
+                'select ixBug, title, tags, project, resolved, updated '
+                'from cases').fetchall()
+        return dict((bug_id, {'title': title,
+                              'tags': json.loads(tags),
+                              'project': project,
+                              'resolved': resolved,
+                              'updated': updated})
+                    for bug_id, title, tags, project, resolved, updated
+                    in rows)
+
+    def save_cases(self, bugs):
+        """Save {ixBug: bug info} records"""
+        with self._lock:
+            self._db.executemany(
+                'insert or replace into cases values (?, ?, ?, ?, ?, ?)',
+                ((bug_id, b['title'], json.dumps(b['tags']), b['project'],
+                  b['resolved'], b.get('updated'))
+                 for bug_id, b in bugs.iteritems()))
+            self._db.commit()
+
+    def load_people(self):
+        with self._lock:
+            rows = self._db.execute(
+                'select ixPerson, name, email from people').fetchall()
+        return dict((dev_id, {'name': name, 'email': email})
+                    for dev_id, name, email in rows)
+
+    def save_people(self, devs):
+        with self._lock:
+            self._db.execute('delete from people')
+            self._db.executemany(
+                'insert into people values (?, ?, ?)',
+                ((dev_id, d['name'], d['email'])
+                 for dev_id, d in devs.iteritems()))
+            self._db.commit()
+
+    def rollup_periods(self):
+        """Returns {period: (fingerprint, computed)}"""
+        with self._lock:
+            rows = self._db.execute(
+                'select period, fingerprint, computed '
+                'from rollup_periods').fetchall()
+        return dict((period, (fingerprint, computed))
+                    for period, fingerprint, computed in rows)
+
+    def stale_rollups(self):
+        """Periods with hours on a case updated since they were computed
+
+        Only cases already in a period's rollup are looked at: hours added
+        later to a period on a case that had none there go unnoticed.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'select distinct r.period from rollups r '
+                'join rollup_periods p on p.period = r.period '
+                'join cases c on c.ixBug = r.ixBug '
+                'where c.updated > p.computed').fetchall()
+        return set(period for period, in rows)
+
+    def load_rollup(self, period):
+        """Returns {(ixPerson, ixBug, type): hours} for period"""
+        with self._lock:
+            rows = self._db.execute(
+                'select ixPerson, ixBug, type, hours from rollups '
+                'where period = ?', (period, )).fetchall()
+        return dict(((dev_id, bug_id, entry_type), hours)
+                    for dev_id, bug_id, entry_type, hours in rows)
+
+    def save_rollup(self, period, fingerprint, computed, sums):
+        """Replace period's rollup with {(ixPerson, ixBug, type): hours}"""
+        with self._lock:
+            self._db.execute('delete from rollups where period = ?',
+                             (period, ))
+            self._db.executemany(
+                'insert into rollups values (?, ?, ?, ?, ?)',
+                ((period, dev_id, bug_id, entry_type, hours)
+                 for (dev_id, bug_id, entry_type), hours
+                 in sums.iteritems()))
+            self._db.execute(
+                'insert or replace into rollup_periods values (?, ?, ?)',
+                (period, fingerprint, computed))
+            self._db.commit()
+
+    def touch_rollup(self, period, computed):
+        """Mark period's rollup as still up to date at computed"""
+        with self._lock:
+            self._db.execute('update rollup_periods set computed = ? '
+                             'where period = ?', (computed, period))
+            self._db.commit()
@@ -0,0 +1,111 @@
+"""Adaptive concurrency limit and retry backoff for API requests
+
+AdaptiveLimiter bounds the number of requests in flight, AIMD-style: the
+limit creeps up while requests succeed at a steady latency, and is cut
+when the server pushes back (429, 503 and the like, dropped connections)
+or when latency climbs well above the lowest seen recently. Backoff
+computes how long to wait before retrying such a request.
+"""
+
+import email.utils
+import logging
+import random
+import threading
+import time
+
+from fogpy.waiting import wait_for
+
+l = logging.getLogger(__name__)
+
+# responses worth retrying, as opposed to e.g. 404
+TRANSIENT_STATUSES = frozenset((429, 500, 502, 503, 504))
+# those telling the request wasn't processed at all, so that even one that
+# changes something can be sent again
+UNPROCESSED_STATUSES = frozenset((429, 503))
+
+def retry_after_seconds(value):
+    """Parse a Retry-After header, either seconds or an HTTP date"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0., email.utils.mktime_tz(date) - time.time())
+
+class Backoff(object):
+    """Jittered exponential backoff
+
+    Attempt n waits a random time between 0 and base * 2**n seconds, at
+    most cap; a Retry-After from the server is waited for instead, plus up
+    to base seconds so that clients don't all come back at once.
+    """
+    def __init__(self, retries=5, base=.25, cap=30.):
+        self.retries, self.base, self.cap = retries, base, cap
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.cap) + random.uniform(0, self.base)
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+class AdaptiveLimiter(object):
+    """Limits concurrent requests to a limit adjusted from their outcome
+
+    Each successful request raises the limit by 1/limit, i.e. by about
+    one per round of requests, up to max_limit. An overloaded request, or
+    one slower than latency_factor times the latency floor (and than
+    min_slow seconds), multiplies it by decrease, down to min_limit. That
+    happens at most once per round trip, the average latency, as the
+    requests already in flight were all sent with the old limit.
+    """
+    def __init__(self, max_limit=8, min_limit=1, initial=None, decrease=.75,
+                 latency_factor=3., min_slow=.05):
+        self.max_limit, self.min_limit = max_limit, min_limit
+        self.limit = float(initial or max_limit)
+        self.decrease = decrease
+        self.latency_factor, self.min_slow = latency_factor, min_slow
+        self.in_flight = 0
+        self.floor = self.average = None
+        self._last_decrease = 0.
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot"""
+        with self._cond:
+            wait_for(lambda: self.in_flight < int(self.limit),
+                     self._cond.wait)
+            self.in_flight += 1
+
+    def release(self, latency, overloaded=False):
+        """Free a slot, with the request's latency and outcome"""
+        with self._cond:
+            self.in_flight -= 1
+            if self.average is None:
+                self.average = latency
+            else:
+                self.average += (latency - self.average) * .1
+            if not overloaded:
+                if self.floor is None or latency < self.floor:
+                    self.floor = latency
+                else:
+                    # drift up, for servers that got slower for good
+                    self.floor += (latency - self.floor) * .01
+                overloaded = latency > max(self.min_slow,
+                                           self.latency_factor * self.floor)
+            if overloaded:
+                self._decrease()
+            else:
+                self.limit = min(self.max_limit, self.limit + 1. / self.limit)
+            self._cond.notify_all()
+
+    def _decrease(self):
+        now = time.time()
+        if now - self._last_decrease < self.average:
+            return
+        self._last_decrease = now
+        limit = max(self.min_limit, self.limit * self.decrease)
+        if int(limit) != int(self.limit):
+            l.debug('concurrency limit down to %d' % limit)
+        self.limit = limit
@@ -13,21 +13,32 @@ as %prog, and define base_url, username and password in there instead
 of specifying -u, -p and -b.
 """
 
+from bisect import bisect_right
+import calendar
 import codecs
+import copy
 from collections import defaultdict, namedtuple
 from cStringIO import StringIO
+import csv
 import datetime as dt
+import hashlib
 import iso8601
+from itertools import izip
 import logging
 from lxml import etree
 from optparse import OptionParser
-import re
 import sys
+import time
 import urllib
 import urllib2
-import xlwt
 
-from fogpy.fogbugzapi import FogBugzAPI
+from fogpy.entries import (ELAPSED, ENTRY_TYPES, TIMESHEET, EntryTable,
+                           Interner, from_epoch, parse_timestamps)
+from fogpy.fogbugzapi import AsyncFogBugzAPI
+from fogpy.metrics import StageProfiler
+from fogpy.respcache import ResponseCache
+from fogpy.spreadsheet import XlsWorkbook, XlsxWorkbook
+from fogpy.store import LocalStore
 
 l = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -49,26 +60,179 @@ class DefaultDictForKey(defaultdict):
         super(DefaultDictForKey, self).__init__(*args, **kwargs)
 
     def __missing__(self, key):
-        return self._default_factory(key)
+        value = self[key] = self._default_factory(key)
+        return value
+
+Interval = namedtuple('Interval', ('id', 'dev_id', 'bug_id', 'start', 'end'))
+ResolvedCase = namedtuple('ResolvedCase', ('bug_id', 'dev_id', 'hours'))
+TimeEntry = namedtuple('TimeEntry', 
+                       ('date', 'bug_num', 'title', 'dev_name', 'hours', 
+                        'project', 'tag', 'url', 'type'))
+
+ROLLUP_PERIODS = ('day', 'month')
+# for batch mode, along with 'total'
+BATCH_PERIODS = {'daily': 'day', 'weekly': 'week', 'monthly': 'month',
+                 'quarterly': 'quarter', 'yearly': 'year'}
+
+def _epoch(d):
+    """datetime, naive ones being UTC, to seconds since the epoch"""
+    return calendar.timegm(d.utctimetuple())
+
+def period_start(d, period):
+    """Start of the day, week (from Monday), month, quarter or year of d"""
+    d = d.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'week':
+        d -= dt.timedelta(days=d.weekday())
+    elif period == 'month':
+        d = d.replace(day=1)
+    elif period == 'quarter':
+        d = d.replace(month=d.month - (d.month - 1) % 3, day=1)
+    elif period == 'year':
+        d = d.replace(month=1, day=1)
+    return d
+
+def next_period(d, period):
+    """Start of the period after the one starting at d"""
+    if period == 'week':
+        return d + dt.timedelta(days=7)
+    months = {'month': 1, 'quarter': 3, 'year': 12}.get(period)
+    if months:
+        month = d.month - 1 + months
+        return d.replace(year=d.year + month // 12, month=month % 12 + 1)
+    return d + dt.timedelta(days=1)
+
+def split_periods(start, end, period):
+    """Calendar periods covering start-end, the first and last ones cut"""
+    periods = []
+    while start < end:
+        next_start = min(next_period(period_start(start, period), period),
+                         end)
+        periods.append((start, next_start))
+        start = next_start
+    return periods
+
+def parse_periods(spec, start=None, end=None):
+    """List of (start, end) from a comma separated spec
+
+    Each item is either a START/END pair of iso8601 dates, 'total' for
+    start-end, or one of BATCH_PERIODS to split start-end by calendar day,
+    week, month, quarter or year. A period that comes up more than once,
+    e.g. the quarter that is also the total, is only listed the first time.
+    """
+    periods = []
+    for item in spec.split(','):
+        item = item.strip()
+        if '/' in item:
+            p_start, p_end = item.split('/', 1)
+            periods.append((iso8601.parse_date(p_start),
+                            iso8601.parse_date(p_end)))
+        elif start is None or end is None:
+            raise ValueError("%r needs a start and end date" % item)
+        elif item == 'total':
+            periods.append((start, end))
+        elif item in BATCH_PERIODS:
+            periods.extend(split_periods(start, end, BATCH_PERIODS[item]))
+        else:
+            raise ValueError("unknown period %r" % item)
+    seen = set()
+    unique = []
+    for period in periods:
+        if period not in seen:
+            seen.add(period)
+            unique.append(period)
+    return unique
+
+def _fingerprint(intervals, resolved):
+    """Digest of the source data of a period's hours"""
+    h = hashlib.sha1()
+    for i in sorted(intervals):
+        h.update(repr(tuple(i)))
+    for b in sorted(resolved):
+        h.update(repr(tuple(b)))
+    return h.hexdigest()
+
+def fixed_tags(all_tags):
+    """Returns a list of the tags but with None first and total, non-timesheet last"""
+    tags = sorted(all_tags)
+    if 'None' in tags: tags.remove('None')
+    tags.insert(0, 'None')
+    if 'total' in tags: tags.remove('total')
+    tags.append('total')
+    if 'non-timesheet' in tags: tags.remove('non-timesheet')
+    tags.append('non-timesheet')
+    return tags
 
 class TimeReporting(object):
     
     def __init__(self, username, password, base_url, 
-                 start_date=None, end_date=None, prefetch=False):
-        self.fbapi = FogBugzAPI(base_url, username, password)
+                 start_date=None, end_date=None, prefetch=False,
+                 bug_chunk_size=100, cache_dir=None, shard_days=None,
+                 max_workers=4, fbapi=None, response_cache=None,
+                 rollup_period=None, settle_days=7, search_page_size=1000):
+        """fbapi shares an existing session; it must be an AsyncFogBugzAPI,
+        as fetches run concurrently"""
+        self.profiler = StageProfiler()
+        if fbapi is None:
+            with self.profiler.stage('login'):
+                fbapi = AsyncFogBugzAPI(base_url, username, password,
+                                        max_in_flight=max_workers,
+                                        cache=response_cache)
+        elif not isinstance(fbapi, AsyncFogBugzAPI):
+            raise TypeError("fbapi must be an AsyncFogBugzAPI, not %s"
+                            % type(fbapi).__name__)
+        self.fbapi = fbapi
+        self.bug_chunk_size = bug_chunk_size
+        self.search_page_size = search_page_size
+        self.shard_days = shard_days
+        if rollup_period not in (None, ) + ROLLUP_PERIODS:
+            raise ValueError("rollup_period must be one of %r" 
+                             % (ROLLUP_PERIODS, ))
+        self.rollup_period = rollup_period
+        self.settle_days = settle_days
         self.bugs = DefaultDictForKey(self.get_buginfo)
         self.hours_perdev = DefaultDictForKey(self.get_hours_for_dev)
         self.start_date, self.end_date = start_date, end_date
+        self.entries = self._entries_period = None
+        # what hours_perdev was summed from, once it has been
+        self._summary_period = self._summary_entries = None
+        self.hours_details = None
         self.all_tags = set()
         self.bad_num_tags = set()
         self.base_url = base_url
+        self.devs = DefaultDictForKey(self.get_devinfo)
+        self.store = None
+        if cache_dir is not None:
+            with self.profiler.stage('load cache'):
+                self.store = LocalStore.for_instance(cache_dir, base_url)
+                self.load_cache()
         if prefetch:
-            self.get_buginfo('all')
-        self.devs = {}
-        self.get_devinfo(9)
+            with self.profiler.stage('resolve bugs'):
+                self.get_buginfo('all')
+        if not self.devs:
+            with self.profiler.stage('login'):
+                self.get_devinfo(0)
 
     def logout(self):
         self.fbapi.logout()
+        if self.store is not None:
+            self.store.close()
+
+    def load_cache(self):
+        """Fill bugs and devs from the local store
+
+        Cases updated in FogBugz since the last sync are fetched again.
+        """
+        sync_time = dt.datetime.utcnow()
+        self.devs.update(self.store.load_people())
+        self.bugs.update(self.store.load_cases())
+        watermark = self.store.get_meta('cases_watermark')
+        l.info('Loaded %d bugs and %d devs from %s' 
+               % (len(self.bugs), len(self.devs), self.store.path))
+        if watermark is not None and self.bugs:
+            since = iso8601.parse_date(watermark)
+            self.get_buginfo('edited:"%s.."' 
+                             % since.strftime('%m/%d/%Y'))
+        self.store.set_meta('cases_watermark', sync_time.isoformat() + 'Z')
     
     def url_for_bug(self, bug_id):
         url_elements = list(urllib2.urlparse.urlsplit(self.base_url))
@@ -86,8 +250,7 @@ class TimeReporting(object):
         resp = self.fbapi.call('listPeople', fIncludeNormal=1, 
                                fIncludeVirtual=1)
         for p in resp.find('people').iterfind('person'):
-            dev_id = int(p.find('ixPerson').text)
-            self.devs[dev_id] = {
+            self.devs[int(p.find('ixPerson').text)] = {
                 'name': p.find('sFullName').text,
                 'email': p.find('sEmail').text
             }
@@ -95,296 +258,603 @@ class TimeReporting(object):
             'name':     'nobody',
             'email':    'eric@ecometrica.com'
         }
+        if self.store is not None:
+            self.store.save_people(self.devs)
+        if dev_id not in self.devs:
+            raise KeyError(dev_id)
         return self.devs[dev_id]
 
     def get_buginfo(self, bug_list):
-        """Fill in info for one or more bugs, or 'all' bugs"""
-        if bug_list == 'all':
-            query = '""'
-        elif isinstance(bug_list, (int, long)):
-            query = 'ixBug:%d' % bug_list
+        """Fill in info for one or more bugs, 'all' bugs, or a search query
+
+        'all' and search queries are fetched search_page_size bugs at a
+        time, the next page being fetched while the current one is read.
+        """
+        cols = 'tags,sTitle,ixBug,sProject,dtResolved,dtLastUpdated'
+        if isinstance(bug_list, basestring):
+            cases = self.fbapi.search('' if bug_list == 'all' else bug_list,
+                                      cols=cols, prefetch=True,
+                                      page_size=self.search_page_size)
         else:
-            query = ' or '.join('ixBug:%d' % bug_id for bug_id in bug_list)
-        resp = self.fbapi.call('search', q=query, 
-                               cols='tags,sTitle,ixBug,sProject,dtResolved')
-        for c in resp.find('cases').findall('case'):
+            if isinstance(bug_list, (int, long)):
+                query = 'ixBug:%d' % bug_list
+            else:
+                query = ' or '.join('ixBug:%d' % bug_id 
+                                    for bug_id in bug_list)
+            cases = self.fbapi.iter_call('search', tag='case', q=query,
+                                         cols=cols)
+        fetched = {}
+        for c in cases:
             bug_id = int(c.find('ixBug').text)
             project = c.find('sProject').text
-            self.bugs[bug_id] = {
+            fetched[bug_id] = self.bugs[bug_id] = {
                 'title': c.find('sTitle').text,
                 'tags': ['%s-%s'%(project, t.text) 
                          for t in c.find('tags').findall('tag')],
                 'project': project,
-                'resolved': c.find('dtResolved').text
+                'resolved': c.find('dtResolved').text,
+                'updated': c.find('dtLastUpdated').text
             }
-        return self.bugs[bug_id]
+        if self.store is not None and fetched:
+            self.store.save_cases(fetched)
+        if isinstance(bug_list, (int, long)):
+            if bug_list not in self.bugs:
+                raise KeyError(bug_list)
+            return self.bugs[bug_list]
+        return fetched
+
+    def resolve_bugs(self, bug_ids):
+        """Fetch info for all the bugs in bug_ids we don't know about yet
+
+        Bugs are fetched bug_chunk_size at a time, instead of one search
+        per bug as they get looked up.
+        """
+        missing = sorted(set(bug_ids).difference(self.bugs))
+        if not missing:
+            return
+        l.info('Fetching info for %d bugs' % len(missing))
+        self.fbapi.gather(*[
+            self.fbapi.submit(self.get_buginfo,
+                              missing[n:n + self.bug_chunk_size])
+            for n in xrange(0, len(missing), self.bug_chunk_size)
+        ])
 
     def get_hours_for_dev(self, dev_name):
         self.get_all_hours_per_tag_per_dev(self.start_date, self.end_date)
         return self.hours_perdev[dev_name]
 
-    def get_all_hours_per_tag_per_dev(self, start=None, end=None):
+    def get_entries(self, start=None, end=None):
+        """Fetch and normalize timesheet and elapsed hours for a period
+
+        This is the only place the period's data gets fetched; the summary
+        and details views, and the CSV and XLS outputs, are all derived
+        from these entries.
+        """
         if start is None: start = self.start_date
         if end is None: end = self.end_date
-        self.hours_perdev = defaultdict(lambda: defaultdict(int))
+        if self.entries is not None and self._entries_period == (start, end):
+            return self.entries
+
+        intervals, resolved = self._fetch_period(start, end)
+        with self.profiler.stage('aggregate'):
+            entries = self._build_entries(intervals, resolved)
+            self._check_entries(entries)
+        self.entries, self._entries_period = entries, (start, end)
+        return entries
+
+    def get_period_reports(self, periods):
+        """A report for each (start, end) in periods, from a single fetch
+
+        The whole range the periods cover is fetched once, then split:
+        intervals by the time they start, resolved cases by their resolved
+        date. Periods may overlap, e.g. months and their quarter. The
+        reports share this one's API session, bugs and devs.
+        """
+        start = min(p_start for p_start, p_end in periods)
+        end = max(p_end for p_start, p_end in periods)
+        intervals, resolved = self._fetch_period(start, end)
+        with self.profiler.stage('aggregate'):
+            starts = parse_timestamps([i.start for i in intervals])
+            resolved_dates = self._resolved_dates(resolved)
+            reports = []
+            for p_start, p_end in periods:
+                lo, hi = _epoch(p_start), _epoch(p_end)
+                entries = self._build_entries(
+                    [i for i, ts in izip(intervals, starts) 
+                     if lo <= ts < hi],
+                    [b for b, ts in izip(resolved, resolved_dates)
+                     if lo <= ts < hi])
+                reports.append(self._period_report(p_start, p_end, entries))
+        return reports
+
+    def _period_report(self, start, end, entries):
+        report = copy.copy(self)
+        report.start_date, report.end_date = start, end
+        report.entries, report._entries_period = entries, (start, end)
+        report.hours_perdev = DefaultDictForKey(report.get_hours_for_dev)
+        report._summary_period = report._summary_entries = None
+        report.hours_details = None
+        report.all_tags, report.bad_num_tags = set(), set()
+        report._check_entries(entries)
+        return report
+
+    def get_rollup_entries(self, start=None, end=None):
+        """Entries summed per period, dev, bug and type
+
+        The report's range is split into whole rollup_period periods, plus
+        partial ones at either end. Whole periods are taken from the local
+        store if they ended more than settle_days ago and none of their
+        cases were updated since they were computed; only the other ones
+        are fetched, and stored for next time. Entries are dated at the
+        start of their period, so they're only good for the summary.
+
+        Hours logged in a stored period on a case that had none in it are
+        missed until the store is wiped: only settle_days guards against
+        late changes, so it should cover how late hours get logged.
+        """
+        if start is None: start = self.start_date
+        if end is None: end = self.end_date
+        computed = from_epoch(time.time())
+        settled = time.time() - self.settle_days * 86400
+        pieces = self._rollup_pieces(start, end)
+
+        with self.profiler.stage('load rollups'):
+            stored = self.store.rollup_periods()
+            stale = self.store.stale_rollups()
+            sums = {}
+            for key, piece_start, piece_end in pieces:
+                if (key in stored and key not in stale
+                        and _epoch(piece_end) <= settled):
+                    sums[key] = self.store.load_rollup(key)
+        l.info('Reusing rollups for %d of %d periods'
+               % (len(sums), len(pieces)))
+
+        # fetch each run of consecutive missing periods in one go
+        runs = []
+        for piece in pieces:
+            if piece[0] in sums:
+                continue
+            if runs and runs[-1][-1][2] == piece[1]:
+                runs[-1].append(piece)
+            else:
+                runs.append([piece])
+        for run in runs:
+            intervals, resolved = self._fetch_period(run[0][1], run[-1][2])
+            with self.profiler.stage('aggregate'):
+                self._rollup_run(run, intervals, resolved, stored,
+                                 computed, sums)
+
+        with self.profiler.stage('aggregate'):
+            entries = EntryTable()
+            for key, piece_start, piece_end in pieces:
+                date = _epoch(piece_start)
+                for (dev_id, bug_id, entry_type), hours in \
+                        sums[key].iteritems():
+                    entries.append(date, bug_id, dev_id, hours, entry_type)
+        with self.profiler.stage('resolve bugs'):
+            # in case the store's cases were wiped since
+            self.resolve_bugs(entries.bug_ids())
+        with self.profiler.stage('aggregate'):
+            self._check_entries(entries)
+        return entries
+
+    def _rollup_pieces(self, start, end):
+        """Split start-end into (key, start, end) periods
+
+        Partial periods at either end get a key of their own, that is
+        never stored.
+        """
+        period = self.rollup_period
+        first = period_start(start, period)
+        if first < start:
+            first = next_period(first, period)
+        pieces = []
+        if start < min(first, end):
+            pieces.append(('partial:%s' % start.isoformat(), start,
+                           min(first, end)))
+        while first < end:
+            next_start = next_period(first, period)
+            if next_start > end:
+                pieces.append(('partial:%s' % first.isoformat(), first, end))
+                break
+            pieces.append(('%s:%s' % (period, first.date().isoformat()),
+                           first, next_start))
+            first = next_start
+        return pieces
+
+    def _rollup_run(self, run, intervals, resolved, stored, computed, sums):
+        """Split a run's source data per period, sum it and store it
+
+        Intervals belong to the period they start in, and resolved cases
+        to the one they were resolved in; _fetch_period only returns those
+        resolved within the run, so the periods add up to a plain report.
+        """
+        bounds = [_epoch(piece_start) for key, piece_start, piece_end in run]
+        run_end = _epoch(run[-1][2])
+        split = [([], []) for piece in run]
+        starts = parse_timestamps([i.start for i in intervals])
+        for i, ts in izip(intervals, starts):
+            n = bisect_right(bounds, ts) - 1
+            if n >= 0 and ts < run_end:
+                split[n][0].append(i)
+        dates = self._resolved_dates(resolved)
+        for b, ts in izip(resolved, dates):
+            n = bisect_right(bounds, ts) - 1
+            if n >= 0 and ts < run_end:
+                split[n][1].append(b)
+
+        for (key, piece_start, piece_end), (p_intervals, p_resolved) in \
+                izip(run, split):
+            sums[key] = self._build_entries(p_intervals, p_resolved
+                                            ).sum_hours('dev', 'bug', 'type')
+            if key.startswith('partial:'):
+                continue
+            fingerprint = _fingerprint(p_intervals, p_resolved)
+            if stored.get(key, (None, ))[0] == fingerprint:
+                l.debug('Rollup for %s unchanged' % key)
+                self.store.touch_rollup(key, computed)
+            else:
+                self.store.save_rollup(key, fingerprint, computed, sums[key])
+
+    def _build_entries(self, intervals, resolved):
+        entries = EntryTable()
 
         # Find all timesheet hours
-        intervals = self._get_intervals_in_daterange(start, end)
-        for i in intervals:
-            try:
-                self._parse_interval(i)
-            except Exception, e:
-                l.error('Problem with interval: ' + etree.tostring(i))
-                raise e
+        starts = parse_timestamps([i.start for i in intervals])
+        ends = parse_timestamps([i.end for i in intervals])
+        for i, start_ts, end_ts in izip(intervals, starts, ends):
+            hours = (end_ts - start_ts) / 3600.
+            if hours == 0:
+                continue
+            entries.append(end_ts, i.bug_id, i.dev_id, hours, TIMESHEET)
 
         # now add non-timesheet elapsed time for bugs resolved in that
         # period, using resolvedby as dev
-        resp = self.fbapi.call(
-            'search', q='resolved:"%s..%s"'%(start.strftime('%m/%d/%Y'),
-                                             end.strftime('%m/%d/%Y')),
-            cols=('ixBug,ixPerson,hrsElapsedExtra,tags,sProject,'
-                  'ixPersonResolvedBy'),
-        )
-        for b in resp.find('cases').iterfind('case'):
-            hours = float(b.find('hrsElapsedExtra').text)
-            if hours == 0:
-                continue
-            bug_id = int(b.find('ixBug').text)
-            dev_id = int(b.find('ixPersonResolvedBy').text)
-            dev_name = self.devs[dev_id]['name']
+        resolved = [b for b in resolved if b.hours != 0]
+        for b, date in izip(resolved, self._resolved_dates(resolved)):
+            entries.append(date, b.bug_id, b.dev_id, b.hours, ELAPSED)
+        return entries
+
+    def _check_entries(self, entries):
+        # look up every dev now, while we're still logged in
+        for dev_id in set(entries.dev):
+            self.devs[dev_id]
+        for bug_id in entries.bug_ids():
             tags = self.bugs[bug_id]['tags']
-            project = self.bugs[bug_id]['project']
-            for t in tags:
-                self.hours_perdev[dev_name][t] += hours
-            if not tags:
-                self.hours_perdev[dev_name]['None'] += hours
-            self.hours_perdev[dev_name]['total'] += hours
-            self.hours_perdev[dev_name]['non-timesheet'] += hours
+            self.all_tags.update(tags)
             if len(tags) != 1:
-                l.warning("Bug with %d tag: %d" % (len(tags), bug_id))
+                l.warning("Bug with %d tags: %d" % (len(tags), bug_id))
                 self.bad_num_tags.add(bug_id)
-            if tags:
-                self.all_tags.update(tags)
-
         if self.bad_num_tags:
             l.warning(u"Some bugs covered by this timesheet have no "
                       u"associated tags, or more than 1 tag: " 
                       + ', '.join(`b` for b in self.bad_num_tags))
             fb_filter = self.fb_filter_for_bugs(self.bad_num_tags)
             l.warning('Equivalent fogbugz filter:' + fb_filter)
-        return self.hours_perdev
-    
-    def get_hours_details(self, start=None, end=None):
+
+    def retag_bad_cases(self, mapping, dry_run=False, retries=2):
+        """Set the tags of the bad_num_tags cases according to mapping
+
+        mapping maps frozensets of tags, as in FogBugz, without the project
+        prefix, to the list of tags to set instead; see parse_tag_mapping.
+        Cases whose tags aren't in it are left alone. The edits run through
+        FogBugzAPI.edit_many, and the report is updated with the new tags
+        of the cases edited. Returns the EditResults.
+        """
+        edits = []
+        for bug_id in sorted(self.bad_num_tags):
+            b = self.bugs[bug_id]
+            prefix = len('%s-' % b['project'])
+            tags = frozenset(t[prefix:] for t in b['tags'])
+            if tags in mapping:
+                edits.append((bug_id, {'sTags': mapping[tags]}))
+        l.info('Retagging %d of %d cases with bad tags'
+               % (len(edits), len(self.bad_num_tags)))
+        results = self.fbapi.edit_many(edits, retries=retries,
+                                       dry_run=dry_run)
+        if dry_run:
+            return results
+
+        edited = {}
+        for r in results:
+            if r.ok:
+                b = self.bugs[r.bug_id]
+                b['tags'] = ['%s-%s' % (b['project'], t)
+                             for t in r.changes['sTags']]
+                edited[r.bug_id] = b
+                self.all_tags.update(b['tags'])
+                if len(b['tags']) == 1:
+                    self.bad_num_tags.discard(r.bug_id)
+        if edited:
+            if self.store is not None:
+                self.store.save_cases(edited)
+            if self._summary_period is not None:
+                # same entries, new tags
+                self.get_all_hours_per_tag_per_dev(*self._summary_period)
+        return results
+
+    def get_all_hours_per_tag_per_dev(self, start=None, end=None):
         if start is None: start = self.start_date
         if end is None: end = self.end_date
+        if self._summary_period == (start, end):
+            entries = self._summary_entries
+        elif (self.store is not None and self.rollup_period is not None
+                and self._entries_period != (start, end)):
+            entries = self.get_rollup_entries(start, end)
+        else:
+            entries = self.get_entries(start, end)
+        with self.profiler.stage('aggregate'):
+            hours = self._sum_hours_perdev(entries)
+        self._summary_period, self._summary_entries = (start, end), entries
+        return hours
 
-        TimeEntry = namedtuple('TimeEntry', 
-                               ('date', 'bug_num', 'title', 'dev_name', 'hours', 
-                                'project', 'tag', 'url', 'type'))
-        entries = []
-        # Find all timesheet hours
-        intervals = self._get_intervals_in_daterange(start, end)
-        for i in intervals:
-            hours = (
-                iso8601.parse_date(i.find('dtEnd').text)
-                - iso8601.parse_date(i.find('dtStart').text) 
-            ).total_seconds() / 3600.
-            if hours == 0:
+    def _sum_hours_perdev(self, entries):
+        # sum per dev and bug first, then spread that over the bug's tags
+        tags = Interner(['total', 'non-timesheet', 'None'])
+        bug_tags = {}
+        sums = defaultdict(float)
+        for (dev_id, bug_id, entry_type), hours in entries.sum_hours(
+                'dev', 'bug', 'type').iteritems():
+            if bug_id not in bug_tags:
+                bug_tags[bug_id] = [tags.code(t) for t in
+                                    self.bugs[bug_id]['tags'] or ['None']]
+            for t in bug_tags[bug_id]:
+                sums[dev_id, t] += hours
+            sums[dev_id, 0] += hours
+            if entry_type == ELAPSED:
+                sums[dev_id, 1] += hours
+
+        self.hours_perdev = defaultdict(lambda: defaultdict(int))
+        for (dev_id, t), hours in sums.iteritems():
+            self.hours_perdev[self.devs[dev_id]['name']][tags[t]] += hours
+        return self.hours_perdev
+    
+    def iter_hours_details(self, start=None, end=None):
+        """Yields a TimeEntry per entry and tag"""
+        entries = self.get_entries(start, end)
+        for date, bug_id, dev_id, hours, entry_type in entries.rows():
+            if entry_type == ELAPSED and dev_id == 0:
+                # it's been reopened, ignore
                 continue
-            dev_name = self.devs[int(i.find('ixPerson').text)]['name']
-            bug_id = int(i.find('ixBug').text)
+            dev_name = self.devs[dev_id]['name']
             b = self.bugs[bug_id]
-            tags = b['tags'] or ['None', ]
-            for t in tags:
-                entries.append(
-                    TimeEntry(i.find('dtEnd').text, bug_id, b['title'], 
-                              dev_name, hours, b['project'], t, 
-                              self.url_for_bug(bug_id), 'timesheet')
-                )
-            self.all_tags.update(b['tags'])
-            if len(b['tags']) != 1:
-                l.warning("Bug with %d tags: %d" % (len(b['tags']), bug_id))
-                self.bad_num_tags.add(bug_id)
+            for t in b['tags'] or ['None', ]:
+                yield TimeEntry(from_epoch(date), bug_id, b['title'],
+                                dev_name, hours, b['project'], t, 
+                                self.url_for_bug(bug_id),
+                                ENTRY_TYPES[entry_type])
 
-        # now add non-timesheet elapsed time for bugs resolved in that
-        # period, using resolvedby as dev
-        resp = self.fbapi.call(
-            'search', q='resolved:"%s..%s"'%(start.strftime('%m/%d/%Y'),
-                                             end.strftime('%m/%d/%Y')),
+    def get_hours_details(self, start=None, end=None):
+        self.hours_details = list(self.iter_hours_details(start, end))
+        return self.hours_details
+
+    def _date_shards(self, start, end):
+        step = dt.timedelta(days=self.shard_days)
+        while start < end:
+            yield start, min(start + step, end)
+            start += step
+
+    def _fetch_period(self, start, end):
+        """Fetch intervals and resolved cases concurrently, then their bugs
+
+        The resolved search only has a day's precision, so cases resolved
+        outside start-end, e.g. later on the end date, are dropped here,
+        as are reopened ones, which have no resolved date any more. Every
+        report, for a period or split into several, counts the same ones.
+        """
+        with self.profiler.stage('fetch intervals'):
+            resolved = self.fbapi.submit(self._get_resolved_in_daterange,
+                                         start, end)
+            intervals = self._get_intervals_in_daterange(start, end)
+            resolved, = self.fbapi.gather(resolved)
+        with self.profiler.stage('resolve bugs'):
+            self.resolve_bugs([i.bug_id for i in intervals]
+                              + [c.bug_id for c in resolved])
+        lo, hi = _epoch(start), _epoch(end)
+        resolved = [b for b, ts in izip(resolved,
+                                        self._resolved_dates(resolved))
+                    if lo <= ts < hi]
+        return intervals, resolved
+
+    def _resolved_dates(self, resolved):
+        """Seconds since the epoch each ResolvedCase was resolved at"""
+        return parse_timestamps([self.bugs[b.bug_id]['resolved']
+                                 for b in resolved])
+
+    def _get_intervals_in_daterange(self, start, end):
+        """Fetch intervals, shard_days at a time, concurrently
+
+        Intervals straddling two shards are returned for both, so they're
+        de-duplicated by ixInterval.
+        """
+        if not self.shard_days:
+            return self._fetch_intervals(start, end)
+        results = self.fbapi.gather(*[
+            self.fbapi.submit(self._fetch_intervals, shard_start, shard_end)
+            for shard_start, shard_end in self._date_shards(start, end)
+        ])
+        seen = set()
+        intervals = []
+        for shard in results:
+            for i in shard:
+                if i.id not in seen:
+                    seen.add(i.id)
+                    intervals.append(i)
+        return intervals
+
+    def _fetch_intervals(self, start, end):
+        intervals = self.fbapi.iter_call('listIntervals', tag='interval',
+                                         ixPerson=1,
+                                         dtStart=start.isoformat()+'Z', 
+                                         dtEnd=end.isoformat()+'Z')
+        result = []
+        for i in intervals:
+            # i is cleared once the next one is read
+            try:
+                result.append(Interval(int(i.find('ixInterval').text),
+                                       int(i.find('ixPerson').text),
+                                       int(i.find('ixBug').text),
+                                       i.find('dtStart').text,
+                                       i.find('dtEnd').text))
+            except Exception:
+                l.error('Problem with interval: ' + etree.tostring(i))
+                raise
+        return result
+
+    def _get_resolved_in_daterange(self, start, end):
+        cases = self.fbapi.iter_call(
+            'search', tag='case',
+            q='resolved:"%s..%s"'%(start.strftime('%m/%d/%Y'),
+                                   end.strftime('%m/%d/%Y')),
             cols=('ixBug,ixPerson,hrsElapsedExtra,tags,sProject,'
                   'ixPersonResolvedBy'),
         )
-        for b in resp.find('cases').iterfind('case'):
-            bug_id = int(b.find('ixBug').text)
-            dev_id = int(b.find('ixPersonResolvedBy').text)
-            hours = float(b.find('hrsElapsedExtra').text)
-            if dev_id == 0 or hours == 0:
-                # it's been reopened, or there's no hours, ignore
-                continue
-            dev_name = self.devs[dev_id]['name']
-            bug = self.bugs[bug_id]
-            tags = bug['tags'] or ['None', ]
-            for t in tags:
-                entries.append(
-                    TimeEntry(bug['resolved'], bug_id, bug['title'], dev_name, hours, 
-                              bug['project'], t, self.url_for_bug(bug_id), 
-                              'elapsed')
-                )
-            self.all_tags.update(bug['tags'])
-            if len(bug['tags']) != 1:
-                self.bad_num_tags.add(bug_id)
+        return [ResolvedCase(int(b.find('ixBug').text),
+                             int(b.find('ixPersonResolvedBy').text),
+                             float(b.find('hrsElapsedExtra').text))
+                for b in cases]
+    
+    def _fixed_tags(self):
+        return fixed_tags(self.all_tags)
+
+    def _csv_writer(self, f):
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        def writerow(row):
+            writer.writerow([c.encode('utf8') if isinstance(c, unicode) else c
+                             for c in row])
+        return writerow
 
+    def _write_csv_bad_tags(self, writerow, filter_label):
         if self.bad_num_tags:
-            l.warning(u"Some bugs covered by this timesheet have no "
-                      u"associated tags, or more than 1 tag: " 
-                      + ', '.join(`b` for b in self.bad_num_tags))
+            writerow(['Bugs with len(tags) != 1:',
+                      ' '.join(`b` for b in self.bad_num_tags)])
             fb_filter = self.fb_filter_for_bugs(self.bad_num_tags)
-            l.warning('Equivalent fogbugz filter:' + fb_filter)
-        self.hours_details = entries
-        return entries
-    
-    def _parse_interval(self, i):
-        hours = (
-            iso8601.parse_date(i.find('dtEnd').text)
-            - iso8601.parse_date(i.find('dtStart').text) 
-        ).total_seconds() / 3600.
-        if hours == 0:
-            return
-        dev_name = self.devs[int(i.find('ixPerson').text)]['name']
-        bug_id = int(i.find('ixBug').text)
-        tags = self.bugs[bug_id]['tags']
-        if len(tags) != 1:
-            l.warning("Bug with %d tag: %d" % (len(tags), bug_id))
-            self.bad_num_tags.add(bug_id)
-        self.all_tags.update(tags)
-        for t in tags:
-            self.hours_perdev[dev_name][t] += hours
-        if not tags:
-            self.hours_perdev[dev_name]['None'] += hours
-        self.hours_perdev[dev_name]['total'] += hours
-
-    def _get_intervals_in_daterange(self, start, end):
-        resp = self.fbapi.call(cmd='listIntervals', ixPerson=1, 
-                               dtStart=start.isoformat()+'Z', 
-                               dtEnd=end.isoformat()+'Z')
-        return resp.find('intervals').iterfind('interval')
-    
-    def _fixed_tags(self):
-        """Returns a list of the tags but with None first and total, non-timesheet last"""
-        tags = sorted(self.all_tags.copy())
-        if 'None' in tags: tags.remove('None')
-        tags.insert(0, 'None')
-        if 'total' in tags: tags.remove('total')
-        tags.append('total')
-        if 'non-timesheet' in tags: tags.remove('non-timesheet')
-        tags.append('non-timesheet')
-        return tags
+            writerow([filter_label, fb_filter])
+            l.info("Bad tags fb filter: " + fb_filter)
+        else:
+            writerow(['Bugs with no tags:', 'none'])
 
-    def csv_cumulative_hours(self):
-        if not self.hours_perdev:
+    def write_csv_cumulative(self, f):
+        """Write the hours per dev per tag summary to f as TSV"""
+        if self._summary_period is None:
             self.get_all_hours_per_tag_per_dev()
 
         tags = self._fixed_tags()
-
-        lines = []
-        lines.append('dev name\t' + '\t'.join(tags) + '\n')
+        writerow = self._csv_writer(f)
+        writerow(['dev name'] + tags)
+        writerow([])
         for k, v in self.hours_perdev.iteritems():
-            lines.append(k + '\t' + '\t'.join(`v[t]` for t in tags))
+            writerow([k] + [`v[t]` for t in tags])
 
-        lines.append('')
-        if self.bad_num_tags:
-            lines.append('Bugs with len(tags) != 1:' + '\t' 
-                         + ' '.join(`b` for b in self.bad_num_tags))
-            fb_filter = self.fb_filter_for_bugs(self.bad_num_tags)
-            lines.append('Equivalent fogbugz filter:' + fb_filter)
-            l.info("Bad tags fb filter: " + fb_filter)
-        else:
-            lines.append('Bugs with no tags:\tnone' )
-        lines.append('')
-        return '\n'.join(lines)
-    
-    def csv_detailed_hours(self):
-        dblquote_re = re.compile(r'(^".*[^"]$)')
-        lines = []
-        lines.append("Hours details for %s-%s\n" % (self.start_date, self.end_date))
-        if self.bad_num_tags:
-            lines.append('Bugs with len(tags) != 1:' + '\t' 
-                         + ' '.join(`b` for b in self.bad_num_tags))
-            fb_filter = self.fb_filter_for_bugs(self.bad_num_tags)
-            lines.append('Equivalent fogbugz filter:\t' + fb_filter)
-            l.info("Bad tags fb filter: " + fb_filter)
-        else:
-            lines.append('Bugs with no tags:\tnone' )
-        lines.append('date\ttime\tbug_num\ttitle\tdev_name\thours\tproject\ttag\turl\ttype')
-        for entry in self.hours_details:
+        writerow([])
+        self._write_csv_bad_tags(writerow, 'Equivalent fogbugz filter:')
+
+    def write_csv_detailed(self, f):
+        """Write one TSV row per entry and tag to f, as they are produced"""
+        writerow = self._csv_writer(f)
+        writerow(["Hours details for %s-%s" % (self.start_date, self.end_date)])
+        writerow([])
+        self._write_csv_bad_tags(writerow, 'Equivalent fogbugz filter:')
+        writerow(['date', 'time', 'bug_num', 'title', 'dev_name', 'hours',
+                  'project', 'tag', 'url', 'type'])
+        for entry in self.iter_hours_details():
             # split date and time, which lets you pivot to sum by day
-            entry = entry[0].split('T') + list(entry[1:])
-            lines.append('\t'.join(dblquote_re.sub(r'"\1"', ('%s'%i)) 
-                                   for i in entry))
+            writerow(entry[0].split('T') + list(entry[1:]))
 
-        return '\n'.join(lines)
+    def csv_cumulative_hours(self):
+        f = StringIO()
+        self.write_csv_cumulative(f)
+        return f.getvalue()
+    
+    def csv_detailed_hours(self):
+        f = StringIO()
+        self.write_csv_detailed(f)
+        return f.getvalue()
 
     def write_xls_report(self, file_out, details=False):
-        if not self.hours_perdev:
-            self.get_all_hours_per_tag_per_dev()
+        wb = XlsWorkbook(file_out)
+        self.add_sheets(wb, details)
+        wb.close()
 
-        header_style = xlwt.XFStyle()
-        header_style.font = xlwt.Font()
-        header_style.font.bold = True
+    def write_xlsx_report(self, file_out, details=False):
+        wb = XlsxWorkbook(file_out)
+        self.add_sheets(wb, details)
+        wb.close()
 
-        wb = xlwt.Workbook(encoding='utf8')
+    def add_sheets(self, wb, details=False, summary_name=u"Summary",
+                   details_name=u"Hours details"):
+        """Add the summary sheet, and the details one, to a spreadsheet
+        workbook; the details go on as many sheets as the rows need"""
+        if self._summary_period is None:
+            self.get_all_hours_per_tag_per_dev()
 
-        ws = wb.add_sheet(u"Summary")
-        self._xls_summary_tab(ws, header_style)
+        ws = wb.add_sheet(summary_name)
+        for cells, bold in self._summary_rows():
+            ws.write_row(cells, bold)
 
         if details:
-            ws = wb.add_sheet(u"Hours details")
-            self._xls_details_tab(ws, header_style)
-
-        wb.save(file_out)
+            ws = wb.add_sheet(details_name)
+            for cells, bold in self._details_rows():
+                ws.write_row(cells, bold)
 
-    def _xls_summary_tab(self, ws, header_style):
+    def _summary_rows(self):
         tags = self._fixed_tags()
-
-        row = 0
-        for col, cell in enumerate([u'dev name'] + tags):
-            ws.write(row, col, cell, header_style)
-        row += 1
+        yield [u'dev name'] + tags, True
 
         for k, v in self.hours_perdev.iteritems():
-            for col, cell in enumerate([k] + [v[t] for t in tags]):
-                ws.write(row, col, cell)
-            row += 1
-        
-        ws.write(row+1, 0, u"Hours for %s-%s" % (self.start_date, self.end_date))
-        row += 2
+            yield [k] + [v[t] for t in tags], False
+
+        yield [], False
+        yield [u"Hours for %s-%s" % (self.start_date, self.end_date)], False
 
+        yield [u"Bugs with len(tags) != 1:"], False
         if self.bad_num_tags:
-            ws.write(row, 0, u"Bugs with len(tags) != 1:")
-            ws.write(row+1, 1, ' '.join(`b` for b in self.bad_num_tags))
-            fb_filter = self.fb_filter_for_bugs(self.bad_num_tags)
-            ws.write(row+2, 0, u"Bad tags fb filter: ")
-            ws.write(row+3, 1, fb_filter)
-            row += 4
+            yield [None, ' '.join(`b` for b in self.bad_num_tags)], False
+            yield [u"Bad tags fb filter: "], False
+            yield [None, self.fb_filter_for_bugs(self.bad_num_tags)], False
         else:
-            ws.write(row, 0, u"Bugs with len(tags) != 1:")
-            ws.write(row+1, 1, 'none')
-            row += 2
-    
-    def _xls_details_tab(self, ws, header_style):
-        row = 0
-        header = (u"date", u"time", u"bug_num", u"title", u"dev_name", u"hours", u"project", u"tag", 
-                  "url", u"type")
-        for col, cell in enumerate(header):
-            ws.write(row, col, cell, header_style)
-        row += 1
-        
-        for entry in self.hours_details:
+            yield [None, 'none'], False
+
+    def _details_rows(self):
+        yield [u"date", u"time", u"bug_num", u"title", u"dev_name", u"hours",
+               u"project", u"tag", u"url", u"type"], True
+        for entry in self.iter_hours_details():
             # split date and time, which lets you pivot to sum by day
-            entry = entry[0].split('T') + list(entry[1:])
-            for col, cell in enumerate(entry):
-                ws.write(row, col, cell)
-            row += 1
+            yield entry[0].split('T') + list(entry[1:]), False
+
+def write_xls_workbook(reports, file_out, details=False,
+                       workbook_class=XlsWorkbook):
+    """Write the sheets of several period reports to a single workbook"""
+    wb = workbook_class(file_out)
+    for tr in reports:
+        name = u'%s..%s' % (tr.start_date.date(), tr.end_date.date())
+        tr.add_sheets(wb, details, summary_name=name,
+                      details_name=name + u' details')
+    wb.close()
+
+def parse_tag_mapping(f):
+    """Read a tag mapping for TimeReporting.retag_bad_cases
+
+    Lines are like "ClientA, R&D = ClientA": the tags of a case, in any
+    order, then those to set instead; nothing on the left is for cases
+    without tags. Empty lines and lines starting with # are skipped.
+    """
+    mapping = {}
+    for n, line in enumerate(f, 1):
+        line = line.decode('utf8').strip()
+        if not line or line.startswith('#'):
+            continue
+        if '=' not in line:
+            raise ValueError("line %d has no '='" % n)
+        old, new = line.split('=', 1)
+        mapping[frozenset(t.strip() for t in old.split(',') if t.strip())] \
+            = [t.strip() for t in new.split(',') if t.strip()]
+    return mapping
+
+def period_filename(template, start, end, extension):
+    return template.replace('#s', start.strftime('%Y-%m-%dT%H:%M:%SZ')
+                   ).replace('#e', end.strftime('%Y-%m-%dT%H:%M:%SZ')
+                   ).replace('#x', extension)
 
 
 if __name__=='__main__':
@@ -400,7 +870,7 @@ if __name__=='__main__':
                       default='time_report_#s-#e.#x',
                       help="Filename to write results to (TSV or Excel). "
                            "#s, #e, #x will insert start and end datetimes, and file extension "
-                           "(csv or xls), respectively. Use - to output to stdout. "
+                           "(csv, xls or xlsx), respectively. Use - to output to stdout. "
                            "[%default]")
     parser.add_option("-b", "--baseurl", dest="base_url",
                       help="Base URL for FogBugz API [%default]",
@@ -411,60 +881,228 @@ if __name__=='__main__':
     parser.add_option("-f", "--prefetch", dest="prefetch", default=False,
                       action='store_true', 
                       help="Prefetch info about all bugs (useful for big reports).")
+    parser.add_option("--bug-chunk-size", dest="bug_chunk_size", default=100,
+                      type='int',
+                      help="Number of bugs to fetch info for per search "
+                           "[%default]")
+    parser.add_option("--search-page-size", dest="search_page_size",
+                      default=1000, type='int',
+                      help="Number of bugs per request when prefetching or "
+                           "syncing the cache [%default]")
+    parser.add_option("--cache-dir", dest="cache_dir", metavar="DIR",
+                      default=settings.get('cache_dir'),
+                      help="Keep bug and dev info in a local database in DIR, "
+                           "and only fetch bugs updated since the last run "
+                           "[%default]")
+    parser.add_option("--shard-days", dest="shard_days", default=None,
+                      type='int',
+                      help="Fetch timesheet intervals this many days at a "
+                           "time, in parallel [%default]")
+    parser.add_option("--workers", dest="max_workers", default=4,
+                      type='int',
+                      help="Maximum number of concurrent API requests "
+                           "[%default]")
+    parser.add_option("--response-cache", dest="response_cache", metavar="DIR",
+                      default=settings.get('response_cache'),
+                      help="Record API responses in DIR, and reuse them "
+                           "instead of calling FogBugz again [%default]")
+    parser.add_option("--response-ttl", dest="response_ttl", default=None,
+                      type='float',
+                      help="Seconds recorded responses stay valid [%default]")
+    parser.add_option("--response-cache-size", dest="response_cache_size",
+                      default=None, type='int', metavar="BYTES",
+                      help="Maximum size of the response cache on disk "
+                           "[%default]")
+    parser.add_option("--replay", dest="replay", default=False,
+                      action='store_true',
+                      help="Only use responses recorded with --response-cache, "
+                           "never call FogBugz.")
+    parser.add_option("--rollups", dest="rollup_period", default=None,
+                      type='choice', choices=ROLLUP_PERIODS,
+                      help="With --cache-dir, keep the summary's hours per "
+                           "day or month, and only fetch the periods that "
+                           "may have changed since [%default]. Hours logged "
+                           "more than --settle-days late, on a case without "
+                           "hours in that period yet, are missed.")
+    parser.add_option("--settle-days", dest="settle_days", default=7,
+                      type='int',
+                      help="Always fetch rollup periods that ended less "
+                           "than this many days ago [%default]")
+    parser.add_option("--periods", dest="periods", default=None,
+                      help="Batch mode: one report per period, all from a "
+                           "single fetch. Comma separated list of START/END "
+                           "iso8601 pairs, 'total' for the whole range, or "
+                           "daily, weekly, monthly, quarterly or yearly to "
+                           "split it, e.g. monthly,quarterly,total. "
+                           "Use #s and #e in -o to get one file per period.")
+    parser.add_option("--workbook", dest="workbook", default=False,
+                      action='store_true',
+                      help="With --periods and -x, write every period's "
+                           "sheets to a single workbook.")
+    parser.add_option("--retag", dest="retag", metavar="FILE", default=None,
+                      help="Set the tags of the cases with no tags or more "
+                           "than 1 according to FILE, before writing the "
+                           "report. FILE has lines like 'ClientA, R&D = "
+                           "ClientA': a case's tags, then those to set "
+                           "instead; nothing left of = is for cases without "
+                           "tags.")
+    parser.add_option("--dry-run", dest="dry_run", default=False,
+                      action='store_true',
+                      help="With --retag, only log the edits it would make.")
+    parser.add_option("--profile", dest="profile", default=False,
+                      action='store_true',
+                      help="Print time spent per stage and per API command "
+                           "to stderr at exit.")
     parser.add_option("-x", "--xls", dest="xls", default=False,
                       action='store_true', 
                       help="Output xls file with short summary sheet. "
                            "And long details sheet if -l/--long is provided.")
+    parser.add_option("--xlsx", dest="xlsx", default=False,
+                      action='store_true',
+                      help="Like -x/--xls, but output an xlsx file, which "
+                           "holds 1048576 rows per sheet instead of 65536 "
+                           "before details go on to another sheet.")
 
     (options, args) = parser.parse_args()
 
     errors = 0
-    if len(args) < 2:
+    periods = None
+    if options.periods:
+        try:
+            periods = parse_periods(options.periods,
+                                    *[iso8601.parse_date(a) for a in args[:2]])
+        except (ValueError, iso8601.ParseError), e:
+            l.error("Bad --periods: %s" % e)
+            errors += 1
+        if options.workbook and not (options.xls or options.xlsx):
+            l.error("--workbook needs -x/--xls or --xlsx")
+            errors += 1
+        elif (not options.workbook and options.outfile != '-'
+                and '#s' not in options.outfile
+                and '#e' not in options.outfile):
+            l.error("Use #s or #e in the output filename with --periods, "
+                    "or --workbook")
+            errors += 1
+    elif len(args) < 2:
         l.error("You need to provide start and end date, in iso8601 format")
         parser.print_help
         errors += 1
+    if options.retag and options.periods:
+        l.error("--retag can't be used with --periods")
+        errors += 1
+    if options.retag and options.replay:
+        l.error("--retag can't be used with --replay")
+        errors += 1
     if options.username is None:
         l.error("No username given")
         errors += 1
     if options.password is None:
         l.error("No password given")
         errors += 1
+    if options.replay and not options.response_cache:
+        l.error("--replay needs --response-cache")
+        errors += 1
+    tag_mapping = None
+    if options.retag:
+        try:
+            with open(options.retag) as mapping_file:
+                tag_mapping = parse_tag_mapping(mapping_file)
+        except (IOError, ValueError), e:
+            l.error("Bad --retag file: %s" % e)
+            errors += 1
     if errors:
         parser.print_help()
         sys.exit(1)
 
-    start_date = iso8601.parse_date(args[0])
-    end_date = iso8601.parse_date(args[1])
-    filename = options.outfile.replace('#s', args[0]).replace('#e', args[1]).replace(
-        '#x', 'xls' if options.xls else 'csv'
-    )
+    if options.xlsx:
+        extension = 'xlsx'
+    elif options.xls:
+        extension = 'xls'
+    else:
+        extension = 'csv'
+    if periods:
+        start_date = min(p_start for p_start, p_end in periods)
+        end_date = max(p_end for p_start, p_end in periods)
+        filename = period_filename(options.outfile, start_date, end_date,
+                                   extension)
+    else:
+        start_date = iso8601.parse_date(args[0])
+        end_date = iso8601.parse_date(args[1])
+        filename = options.outfile.replace('#s', args[0]).replace('#e', args[1]).replace(
+            '#x', extension
+        )
     if filename == '-':
         f = sys.stdout
-    else:
+    elif not periods or options.workbook:
         f = open(filename, 'wb')
         #f = codecs.open(filename, 'w', 'utf8')
 
+    response_cache = None
+    if options.response_cache:
+        response_cache = ResponseCache(directory=options.response_cache,
+                                       ttl=options.response_ttl,
+                                       max_bytes=options.response_cache_size,
+                                       replay=options.replay)
     tr = TimeReporting(options.username, options.password,
                        options.base_url, start_date, end_date, 
-                       prefetch=options.prefetch)
+                       prefetch=options.prefetch,
+                       bug_chunk_size=options.bug_chunk_size,
+                       search_page_size=options.search_page_size,
+                       cache_dir=options.cache_dir,
+                       shard_days=options.shard_days,
+                       max_workers=options.max_workers,
+                       response_cache=response_cache,
+                       rollup_period=options.rollup_period,
+                       settle_days=options.settle_days)
     try:
-        if options.xls or not options.long:
-            # if CSV and long format, no point in putting the summary info together
-            # but xls needs it always
-            hours = tr.get_all_hours_per_tag_per_dev()
-        if options.long:
-            hours = tr.get_hours_details()
+        # everything is fetched once, the outputs are derived from it
+        if periods:
+            reports = tr.get_period_reports(periods)
+        elif options.long:
+            tr.get_entries()
+        else:
+            tr.get_all_hours_per_tag_per_dev()
+        if tag_mapping is not None:
+            with tr.profiler.stage('retag'):
+                tr.retag_bad_cases(tag_mapping, dry_run=options.dry_run)
+            if not options.long:
+                tr.get_all_hours_per_tag_per_dev()
     finally:
         tr.logout()
 
-    if options.xls:
-        tr.write_xls_report(f, details=options.long)
-    else:
-        # CSV
-        if options.long:
-            csv_hours = tr.csv_detailed_hours()
+    def write_report(tr, f):
+        if options.xlsx:
+            tr.write_xlsx_report(f, details=options.long)
+        elif options.xls:
+            tr.write_xls_report(f, details=options.long)
+        else:
+            # CSV
+            if options.long:
+                tr.write_csv_detailed(f)
+            else:
+                tr.write_csv_cumulative(f)
+            f.flush()
+
+    with tr.profiler.stage('write output'):
+        if not periods:
+            write_report(tr, f)
+        elif options.workbook:
+            write_xls_workbook(reports, f, details=options.long,
+                               workbook_class=XlsxWorkbook if options.xlsx
+                                              else XlsWorkbook)
         else:
-            csv_hours = tr.csv_cumulative_hours()
-        f.write(csv_hours)
+            for report in reports:
+                if filename != '-':
+                    f = open(period_filename(options.outfile,
+                                             report.start_date,
+                                             report.end_date, extension),
+                             'wb')
+                write_report(report, f)
+                if filename != '-':
+                    f.close()
+
+    if options.profile:
+        sys.stderr.write('\n' + tr.profiler.report() + '\n\n'
+                         + tr.fbapi.metrics.report() + '\n')
 
 
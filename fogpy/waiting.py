@@ -0,0 +1,26 @@
+"""Waiting on other threads and processes without ignoring ctrl-c
+
+In Python 2, waiting on a lock, condition, event or result without a
+timeout can't be interrupted, not even with ctrl-c, while waiting a little
+at a time can. wait_for does that for any of them.
+"""
+
+import time
+
+# longest wait_for waits for at once
+POLL_SECONDS = 1.
+
+def wait_for(done, wait, timeout=None):
+    """Call wait(seconds) until done() is true, or timeout seconds passed
+
+    Returns whether done() became true.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while not done():
+        seconds = POLL_SECONDS
+        if deadline is not None:
+            seconds = min(seconds, deadline - time.time())
+            if seconds <= 0:
+                return False
+        wait(seconds)
+    return True